@@ -44,12 +44,15 @@ def add_test_users():
         },
     ]
 
+    # Index the existing user_ids once instead of scanning all participants for every test user
+    existing_user_ids = {p["user_id"] for p in participants.values()}
     for user in test_users:
         # Check if user already exists to avoid duplicates
-        if not any(p["user_id"] == user["user_id"] for p in participants.values()):
+        if user["user_id"] not in existing_user_ids:
             # Using a dummy chat_id for test users, it's not critical as long as it's unique
-            dummy_chat_id = f"test_{user["user_id"]}"
+            dummy_chat_id = f"test_{user['user_id']}"
             participants[dummy_chat_id] = user
+            existing_user_ids.add(user["user_id"])
     
     data["participants"] = participants
     save_data(data)
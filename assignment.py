@@ -0,0 +1,422 @@
+import logging
+import random
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Random permutations tried before falling back to matching. A valid draw has
+# probability about e^-(1 + k/n) for k excluded pairs, so with sparse
+# exclusions this almost never runs out.
+REJECTION_ROUNDS = 64
+# Swap attempts per participant used to randomize a matching found by the fallback
+MIXING_SWAPS_PER_PARTICIPANT = 20
+# Upper bound on backtracking steps when cycle patching cannot build a single ring
+CYCLE_SEARCH_BUDGET = 200_000
+# Random swap partners tried per invalid pair before _repair gives up
+REPAIR_ATTEMPTS = 200
+# Forbidden receivers of a giver without exclusions
+NOBODY = frozenset()
+
+
+class AssignmentError(Exception):
+    """Raised when no valid assignment exists for the given exclusions.
+
+    `givers` and `receivers` hold a Hall violation when one was found: every
+    giver in `givers` may only give to someone in `receivers`, and there are
+    fewer receivers than givers, so no assignment can satisfy all of them.
+    """
+
+    def __init__(self, message: str, givers=(), receivers=()):
+        super().__init__(message)
+        self.givers = list(givers)
+        self.receivers = list(receivers)
+
+
+def build_exclusions(pairs) -> dict:
+    """Turns (user_id, user_id) pairs into a giver -> set(receivers) map, in both directions."""
+    exclusions = {}
+    for u1_id, u2_id in pairs:
+        exclusions.setdefault(u1_id, set()).add(u2_id)
+        exclusions.setdefault(u2_id, set()).add(u1_id)
+    return exclusions
+
+
+def draw_assignments(user_ids, exclusions: dict = None, single_cycle: bool = False, rng=random) -> dict:
+    """Returns a random giver -> receiver mapping over user_ids.
+
+    Nobody gives to themselves and no giver gets a receiver listed in
+    exclusions[giver]. With single_cycle=True the result forms one ring
+    through all participants. Raises AssignmentError if no mapping exists.
+    """
+    user_ids = list(user_ids)
+    n = len(user_ids)
+    if n < 2:
+        raise AssignmentError("At least two participants are required")
+
+    exclusions = exclusions or {}
+    position = {user_id: i for i, user_id in enumerate(user_ids)}
+    # forbidden[i] is the set of receiver indices giver i may not get besides itself. Givers without
+    # exclusions share one empty set and givers with the same exclusion set (a group) share its index set,
+    # so the draw's memory grows with the number of distinct exclusion sets, not with the participants
+    forbidden = []
+    index_sets = {}
+    for user_id in user_ids:
+        excluded = exclusions.get(user_id)
+        if not excluded:
+            forbidden.append(NOBODY)
+            continue
+        blocked = index_sets.get(id(excluded))
+        if blocked is None:
+            blocked = index_sets[id(excluded)] = frozenset(position[r] for r in excluded if r in position)
+        forbidden.append(blocked)
+
+    if single_cycle:
+        receivers = _draw_cycle(n, forbidden, rng, user_ids)
+    else:
+        receivers = _draw_derangement(n, forbidden, rng, user_ids)
+    return {user_ids[i]: user_ids[receivers[i]] for i in range(n)}
+
+
+def add_participant(assignments: dict, user_id: str, exclusions: dict = None, rng=random) -> dict:
+    """Splices a late joiner into existing assignments and returns only the changed pairs.
+
+    Some giver a -> b becomes a -> user_id -> b, so exactly two givers are
+    affected and a single gift circle stays a single circle.
+    """
+    if user_id in assignments:
+        raise AssignmentError("This participant already has a receiver")
+    allowed = _allowed_check(exclusions)
+    pairs = list(assignments.items())
+    rng.shuffle(pairs)
+    for giver, receiver in pairs:
+        if allowed(giver, user_id) and allowed(user_id, receiver):
+            return {giver: user_id, user_id: receiver}
+    raise AssignmentError("No existing pair can take in this participant with the current exclusions", [user_id])
+
+
+def remove_participant(assignments: dict, user_id: str, exclusions: dict = None, rng=random) -> dict:
+    """Takes a dropout out of existing assignments and returns the changed pairs of the remaining givers.
+
+    The caller drops user_id's own pair. Usually the dropout's giver simply
+    takes over the dropout's receiver; if exclusions forbid that, another
+    participant is moved into the gap instead, affecting three givers. Single
+    gift circles stay single circles. With only two givers the other one
+    would be left with nobody to give to, so that raises too; callers undo
+    the draw instead.
+    """
+    receiver = assignments.get(user_id)
+    if receiver is None:
+        raise AssignmentError("This participant has no receiver")
+    if len(assignments) <= 2:
+        raise AssignmentError("The only other giver would be left without a receiver")
+    giver_of = {r: g for g, r in assignments.items()}
+    giver = giver_of[user_id]
+    allowed = _allowed_check(exclusions)
+    others = [g for g in assignments if g not in (user_id, giver, receiver)]
+    rng.shuffle(others)
+
+    if giver == receiver:
+        # The dropout and their giver only gave to each other; the giver joins another pair
+        for a in others:
+            b = assignments[a]
+            if b not in (user_id, giver) and allowed(a, giver) and allowed(giver, b):
+                return {a: giver, giver: b}
+        raise AssignmentError("Nobody else can take in this participant's giver", [giver])
+
+    if allowed(giver, receiver):
+        return {giver: receiver}
+    # p -> y -> s becomes p -> s, and y fills the gap: giver -> y -> receiver
+    for y in others:
+        p, s = giver_of[y], assignments[y]
+        if p != s and allowed(p, s) and allowed(giver, y) and allowed(y, receiver):
+            return {giver: y, y: receiver, p: s}
+    raise AssignmentError("Could not close the gap left by this participant with the current exclusions",
+                          [giver])
+
+
+def _allowed_check(exclusions):
+    exclusions = exclusions or {}
+
+    def allowed(giver, receiver) -> bool:
+        return giver != receiver and receiver not in exclusions.get(giver, ())
+    return allowed
+
+
+def _is_valid(permutation, forbidden) -> bool:
+    for i, j in enumerate(permutation):
+        if j == i or j in forbidden[i]:
+            return False
+    return True
+
+
+def _allowed(forbidden, giver: int, receiver: int) -> bool:
+    return receiver != giver and receiver not in forbidden[giver]
+
+
+def _repair(permutation, forbidden, rng) -> bool:
+    """Swaps receivers until every giver has an allowed one; False if some giver could not be fixed.
+
+    Each swap fixes one giver without breaking the other, so the loop runs
+    once per invalid pair.
+    """
+    n = len(permutation)
+    for i in range(n):
+        if _allowed(forbidden, i, permutation[i]):
+            continue
+        for _ in range(REPAIR_ATTEMPTS):
+            j = rng.randrange(n)
+            if _allowed(forbidden, i, permutation[j]) and _allowed(forbidden, j, permutation[i]):
+                permutation[i], permutation[j] = permutation[j], permutation[i]
+                break
+        else:
+            return False
+    return True
+
+
+def _draw_derangement(n, forbidden, rng, user_ids) -> list:
+    # Rejection sampling is exactly uniform over all valid assignments
+    permutation = list(range(n))
+    for _ in range(REJECTION_ROUNDS):
+        rng.shuffle(permutation)
+        if _is_valid(permutation, forbidden):
+            return permutation
+
+    # With many exclusions (big teams) a random permutation is rarely valid, but only a few of its pairs are
+    # wrong; swapping those away is linear, while matching needs an allowed list of every giver's receivers
+    if _repair(permutation, forbidden, rng):
+        return permutation
+
+    logger.info(f"Rejection sampling failed for {n} participants, falling back to matching")
+    allowed = _allowed_lists(n, forbidden, rng)
+    permutation = _perfect_matching(n, allowed, user_ids)
+    # Random valid swaps spread the matching over the space of valid assignments
+    for _ in range(MIXING_SWAPS_PER_PARTICIPANT * n):
+        i = rng.randrange(n)
+        j = rng.randrange(n)
+        if _allowed(forbidden, i, permutation[j]) and _allowed(forbidden, j, permutation[i]):
+            permutation[i], permutation[j] = permutation[j], permutation[i]
+    return permutation
+
+
+def _draw_cycle(n, forbidden, rng, user_ids) -> list:
+    # Sattolo's algorithm draws a uniformly random single n-cycle
+    for _ in range(REJECTION_ROUNDS):
+        cycle = list(range(n))
+        for i in range(n - 1, 0, -1):
+            j = rng.randrange(i)
+            cycle[i], cycle[j] = cycle[j], cycle[i]
+        if _is_valid(cycle, forbidden):
+            return cycle
+
+    logger.info(f"Rejection sampling failed for {n} participants, patching cycles together")
+    # A ring is a special valid assignment, so if none exists this raises with the proof
+    permutation = _draw_derangement(n, forbidden, rng, user_ids)
+    cycle = _merge_cycles(permutation, forbidden, rng)
+    if cycle is None:
+        cycle = _search_cycle(n, _allowed_lists(n, forbidden, rng), forbidden, rng)
+    if cycle is None:
+        raise AssignmentError(
+            "Could not join everyone into a single gift circle with these exclusions; try the default mode"
+        )
+    return cycle
+
+
+def _allowed_lists(n, forbidden, rng) -> list:
+    allowed = []
+    for i in range(n):
+        receivers = [j for j in range(n) if j != i and j not in forbidden[i]]
+        rng.shuffle(receivers)
+        allowed.append(receivers)
+    return allowed
+
+
+def _perfect_matching(n, allowed, user_ids) -> list:
+    """Hopcroft-Karp; returns receiver index per giver or raises AssignmentError with a Hall violation."""
+    unmatched = -1
+    match_giver = [unmatched] * n
+    match_receiver = [unmatched] * n
+
+    def bfs():
+        distance = [None] * n
+        queue = deque()
+        for g in range(n):
+            if match_giver[g] == unmatched:
+                distance[g] = 0
+                queue.append(g)
+        found = False
+        while queue:
+            g = queue.popleft()
+            for r in allowed[g]:
+                other = match_receiver[r]
+                if other == unmatched:
+                    found = True
+                elif distance[other] is None:
+                    distance[other] = distance[g] + 1
+                    queue.append(other)
+        return found, distance
+
+    def dfs(root, distance):
+        # Iterative augmenting path search along the BFS layers
+        stack = [(root, iter(allowed[root]))]
+        path = []
+        while stack:
+            g, receivers = stack[-1]
+            advanced = False
+            for r in receivers:
+                other = match_receiver[r]
+                if other == unmatched:
+                    path.append((g, r))
+                    for pg, pr in path:
+                        match_giver[pg] = pr
+                        match_receiver[pr] = pg
+                    return True
+                if distance[other] == distance[g] + 1:
+                    path.append((g, r))
+                    stack.append((other, iter(allowed[other])))
+                    advanced = True
+                    break
+            if not advanced:
+                distance[g] = None
+                stack.pop()
+                if path:
+                    path.pop()
+        return False
+
+    while True:
+        found, distance = bfs()
+        if not found:
+            break
+        for g in range(n):
+            if match_giver[g] == unmatched:
+                dfs(g, distance)
+
+    free_givers = [g for g in range(n) if match_giver[g] == unmatched]
+    if free_givers:
+        givers, receivers = _hall_violation(free_givers, allowed, match_receiver)
+        raise AssignmentError(
+            f"No valid assignment exists: {len(givers)} participant(s) can only give to "
+            f"{len(receivers)} other(s)",
+            givers=[user_ids[g] for g in givers],
+            receivers=[user_ids[r] for r in receivers],
+        )
+    return match_giver
+
+
+def _hall_violation(free_givers, allowed, match_receiver):
+    # Givers reachable from an unmatched giver by alternating paths have too few receivers
+    seen_givers = set(free_givers)
+    seen_receivers = set()
+    queue = deque(free_givers)
+    while queue:
+        g = queue.popleft()
+        for r in allowed[g]:
+            if r not in seen_receivers:
+                seen_receivers.add(r)
+                other = match_receiver[r]
+                if other not in seen_givers:
+                    seen_givers.add(other)
+                    queue.append(other)
+    return sorted(seen_givers), sorted(seen_receivers)
+
+
+def _merge_cycles(permutation, forbidden, rng):
+    """Joins the cycles of a valid permutation into one ring by swapping receivers.
+
+    Swapping the receivers of a and c from different cycles splices the two
+    cycles together. Returns None if some cycle has no valid splice left.
+    """
+    n = len(permutation)
+    label = [None] * n
+    members = {}
+    for start in range(n):
+        if label[start] is None:
+            cycle_members = []
+            v = start
+            while label[v] is None:
+                label[v] = start
+                cycle_members.append(v)
+                v = permutation[v]
+            members[start] = cycle_members
+
+    while len(members) > 1:
+        smallest = min(members, key=lambda key: len(members[key]))
+        others = [v for v in range(n) if label[v] != smallest]
+        rng.shuffle(others)
+        merged = False
+        for a in members[smallest]:
+            for c in others:
+                if _allowed(forbidden, a, permutation[c]) and _allowed(forbidden, c, permutation[a]):
+                    permutation[a], permutation[c] = permutation[c], permutation[a]
+                    target = label[c]
+                    for v in members[smallest]:
+                        label[v] = target
+                    members[target].extend(members.pop(smallest))
+                    merged = True
+                    break
+            if merged:
+                break
+        if not merged:
+            return None
+    return permutation
+
+
+def _search_cycle(n, allowed, forbidden, rng):
+    """Backtracking search for a ring, used when patching cycles gets stuck.
+
+    Finding a Hamiltonian cycle is NP-hard in general, so the search is cut
+    off after CYCLE_SEARCH_BUDGET steps and returns None. A branch is pruned
+    as soon as some participant has nobody left who could give to them.
+    """
+    # givers_left[u] counts possible givers of u that are unvisited or at the end of the path
+    givers_left = [0] * n
+    for giver in range(n):
+        for receiver in allowed[giver]:
+            givers_left[receiver] += 1
+
+    def consume(tail, nxt) -> bool:
+        # tail now gives to nxt, so it stops being a possible giver for anyone else
+        ok = True
+        for u in allowed[tail]:
+            givers_left[u] -= 1
+            if u != nxt and givers_left[u] == 0 and (not visited[u] or u == start):
+                ok = False
+        return ok
+
+    def release(tail) -> None:
+        for u in allowed[tail]:
+            givers_left[u] += 1
+
+    start = rng.randrange(n)
+    order = [start]
+    visited = [False] * n
+    visited[start] = True
+    stack = [iter(allowed[start])]
+    steps = 0
+    while stack:
+        steps += 1
+        if steps > CYCLE_SEARCH_BUDGET:
+            return None
+        nxt = next(stack[-1], None)
+        if nxt is None:
+            stack.pop()
+            visited[order.pop()] = False
+            if order:
+                release(order[-1])
+            continue
+        if visited[nxt]:
+            continue
+        if len(order) == n - 1:
+            if start not in forbidden[nxt]:
+                order.append(nxt)
+                cycle = [0] * n
+                for k, giver in enumerate(order):
+                    cycle[giver] = order[(k + 1) % n]
+                return cycle
+            continue
+        if not consume(order[-1], nxt):
+            release(order[-1])
+            continue
+        order.append(nxt)
+        visited[nxt] = True
+        stack.append(iter(allowed[nxt]))
+    return None
@@ -0,0 +1,346 @@
+"""Benchmarks the bot's handlers, the assignment algorithm, the storage layer and memory use.
+
+Handlers are driven with synthetic updates through a fake Bot/Application,
+so nothing touches the network. Every population size runs in its own
+temporary directory, the real data files are never read or written.
+
+    python benchmark.py --sizes 10,1000,100000 --storage sqlite
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+from assignment import build_exclusions, draw_assignments
+from broadcast import BroadcastDispatcher, RateLimiter
+import keyboards
+from participant import STORED, Participant
+
+# main.py refuses to start without these; the values are never sent anywhere
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:benchmark")
+os.environ.setdefault("TELEGRAM_ADMIN_ID", "1")
+
+ADMIN_ID = int(os.environ["TELEGRAM_ADMIN_ID"])
+# Synthetic participants get user/chat ids from here upwards
+FIRST_USER_ID = 1_000_000
+DEFAULT_SIZES = "10,100,1000,10000,100000"
+
+
+class FakeMessage:
+    """Stands in for telegram.Message: records replies instead of sending them."""
+
+    def __init__(self, bot, chat_id, text=None, message_id=1):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self.message_id = message_id
+        self.photo = None
+        self.video = None
+        self.animation = None
+        self.document = None
+        self.caption = None
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(chat_id=self.chat_id, text=text, **kwargs)
+
+    async def reply_html(self, text, **kwargs):
+        return await self.bot.send_message(chat_id=self.chat_id, text=text, **kwargs)
+
+    async def reply_photo(self, photo, **kwargs):
+        return await self.bot.send_photo(chat_id=self.chat_id, photo=photo, **kwargs)
+
+    async def reply_video(self, video, **kwargs):
+        return await self.bot.send_video(chat_id=self.chat_id, video=video, **kwargs)
+
+    async def edit_text(self, text, **kwargs):
+        self.bot.calls += 1
+        return self
+
+
+class FakeBot:
+    """Stands in for telegram.Bot: every API call succeeds instantly and is only counted."""
+
+    username = "benchmark_bot"
+
+    def __init__(self):
+        self.calls = 0
+
+    def _sent(self, chat_id, text=None):
+        self.calls += 1
+        return FakeMessage(self, chat_id, text, message_id=self.calls)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return self._sent(chat_id, text)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        return self._sent(chat_id)
+
+    async def send_video(self, chat_id, video, **kwargs):
+        message = self._sent(chat_id)
+        message.video = types.SimpleNamespace(file_id="benchmark-video", file_unique_id="benchmark-video")
+        return message
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        return self._sent(chat_id)
+
+
+class FakeApplication:
+    """Stands in for telegram.ext.Application: keeps background tasks so they can be awaited and timed."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.tasks = []
+
+    def create_task(self, coroutine, **kwargs):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+    async def drain(self):
+        tasks, self.tasks = self.tasks, []
+        await asyncio.gather(*tasks)
+
+
+def make_update(bot, user_id, text, username=None):
+    user = types.SimpleNamespace(id=user_id, username=username, first_name=f"user{user_id}")
+    chat = types.SimpleNamespace(id=user_id)
+    message = FakeMessage(bot, user_id, text)
+    return types.SimpleNamespace(effective_user=user, effective_chat=chat, message=message)
+
+
+def make_context(application, args=None, user_data=None):
+    return types.SimpleNamespace(bot=application.bot, application=application, args=args or [],
+                                 user_data=user_data if user_data is not None else {})
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class Results:
+    """Collects latency samples per (population size, operation) and prints them as a table."""
+
+    def __init__(self):
+        self.samples = {}
+        # (population size, structure) -> bytes allocated
+        self.memory = {}
+
+    def add(self, size, name, seconds):
+        self.samples.setdefault((size, name), []).append(seconds)
+
+    async def time(self, size, name, awaitable):
+        started = time.perf_counter()
+        result = await awaitable
+        self.add(size, name, time.perf_counter() - started)
+        return result
+
+    def add_memory(self, size, name, allocated_bytes):
+        self.memory[(size, name)] = allocated_bytes
+
+    def report(self, out=sys.stdout):
+        out.write(f"{'size':>7}  {'operation':<36} {'n':>5} {'p50 ms':>10} {'p99 ms':>10} {'ops/s':>10}\n")
+        for (size, name), values in self.samples.items():
+            values = sorted(values)
+            total = sum(values)
+            throughput = len(values) / total if total else float("inf")
+            out.write(f"{size:>7}  {name:<36} {len(values):>5} {percentile(values, 0.5) * 1000:>10.3f} "
+                      f"{percentile(values, 0.99) * 1000:>10.3f} {throughput:>10.1f}\n")
+        if self.memory:
+            out.write(f"\n{'size':>7}  {'memory':<36} {'MB':>10} {'B/participant':>14}\n")
+            for (size, name), allocated in self.memory.items():
+                out.write(f"{size:>7}  {name:<36} {allocated / 1e6:>10.2f} {allocated / size:>14.0f}\n")
+
+
+def synthetic_participant(index):
+    user_id = FIRST_USER_ID + index
+    return str(user_id), str(user_id), f"Участник {index}", f"user{index}", f"Хочу подарок номер {index}"
+
+
+def bench_assignment(results, size, rounds):
+    user_ids = [str(FIRST_USER_ID + i) for i in range(size)]
+    rng = random.Random(size)
+    # Roughly one exclusion per participant, like couples and teams in a real game
+    excluded = {(rng.choice(user_ids), rng.choice(user_ids)) for _ in range(size)}
+    exclusions = build_exclusions((a, b) for a, b in excluded if a != b)
+    for _ in range(rounds):
+        for name, kwargs in (("assignment.derangement", {}),
+                             ("assignment.derangement+exclusions", {"exclusions": exclusions}),
+                             ("assignment.cycle", {"single_cycle": True}),
+                             ("assignment.cycle+exclusions", {"single_cycle": True, "exclusions": exclusions})):
+            started = time.perf_counter()
+            draw_assignments(user_ids, rng=rng, **kwargs)
+            results.add(size, name, time.perf_counter() - started)
+
+
+def allocated_by(build):
+    """Returns (bytes still allocated by what build() returned, peak bytes while building it)."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del kept
+    return current - before, peak - before
+
+
+def bench_memory(results, size):
+    """Compares the resident size of participant records and the draw's peak memory."""
+    # Records are built from fresh strings, so their text is counted as it would be after loading
+
+    def as_dicts():
+        # The participants.json layout the store used to keep in memory
+        participants = {}
+        for index in range(size):
+            chat_id, user_id, name, username, wishlist = synthetic_participant(index)
+            participants[chat_id] = {"user_id": user_id, "name": name, "username": username, "wishlist": wishlist}
+        return participants
+
+    def as_records():
+        participants = {}
+        for index in range(size):
+            chat_id, user_id, name, username, wishlist = synthetic_participant(index)
+            participants[chat_id] = Participant(user_id, name, username, wishlist)
+        return participants
+
+    def as_lazy_records():
+        # What SqliteBackend.load builds: the wishlist text stays in the database
+        participants = {}
+        for index in range(size):
+            chat_id, user_id, name, username, _ = synthetic_participant(index)
+            participants[chat_id] = Participant(user_id, name, username, STORED, None)
+        return participants
+
+    for name, build in (("participants as dicts", as_dicts), ("participants as records", as_records),
+                        ("records, wishlists in storage", as_lazy_records)):
+        results.add_memory(size, name, allocated_by(build)[0])
+
+    user_ids = [str(FIRST_USER_ID + index) for index in range(size)]
+    rng = random.Random(size)
+    # One team of a tenth of the participants plus a few couples, as exclusions.compile_rules builds them
+    team = frozenset(rng.sample(user_ids, size // 10))
+    exclusions = build_exclusions((rng.choice(user_ids), rng.choice(user_ids)) for _ in range(size // 100))
+    exclusions = {giver: frozenset(excluded - {giver}) for giver, excluded in exclusions.items()}
+    exclusions.update({user_id: team for user_id in team if user_id not in exclusions})
+    results.add_memory(size, "draw_assignments peak (team+couples)",
+                       allocated_by(lambda: draw_assignments(user_ids, exclusions, rng=rng))[1])
+
+
+async def bench_storage(results, main, size, store):
+    """Fills the store with `size` participants and times the storage layer on its own."""
+    for index in range(size):
+        chat_id, user_id, name, username, wishlist = synthetic_participant(index)
+        started = time.perf_counter()
+        store.set_name(chat_id, user_id, name, username)
+        store.set_wishlist(chat_id, wishlist)
+        results.add(size, "storage.set_name+set_wishlist", time.perf_counter() - started)
+    await results.time(size, "storage.flush", store.flush())
+
+    started = time.perf_counter()
+    main.StateStore(main.create_storage_backend()).load()
+    results.add(size, "storage.load", time.perf_counter() - started)
+
+
+async def bench_handlers(results, main, size, samples, rounds):
+    bot = FakeBot()
+    application = FakeApplication(bot)
+    store = main.games.default_store
+
+    # New users going through the join conversation
+    for index in range(size, size + samples):
+        user_id = FIRST_USER_ID + index
+        context = make_context(application)
+        await results.time(size, "start", main.start(make_update(bot, user_id, "/start"), context))
+        await results.time(size, "receive_name",
+                           main.receive_name(make_update(bot, user_id, f"Участник {index}"), context))
+        await results.time(size, "receive_wishlist",
+                           main.receive_wishlist(make_update(bot, user_id, f"Хочу подарок номер {index}"), context))
+
+    for _ in range(rounds):
+        store.set_assignments({})
+        await results.time(size, "start_game", main.start_game(make_update(bot, ADMIN_ID, "/start_game"),
+                                                               make_context(application)))
+        await results.time(size, "start_game (notifications)", application.drain())
+
+    chat_ids = list(store.participants)
+    rng = random.Random(size)
+    for _ in range(samples):
+        user_id = int(rng.choice(chat_ids))
+        update = make_update(bot, user_id, keyboards.label(keyboards.MY_SANTA))
+        await results.time(size, "my_santa", main.my_santa(update, make_context(application)))
+
+    for _ in range(rounds):
+        user_data = {"broadcast_type": keyboards.BROADCAST_TEXT, "broadcast_content": "Бенчмарк рассылки"}
+        update = make_update(bot, ADMIN_ID, keyboards.label(keyboards.CONFIRM))
+        await results.time(size, "confirm_broadcast",
+                           main.confirm_broadcast(update, make_context(application, user_data=user_data)))
+        await results.time(size, "confirm_broadcast (delivery)", application.drain())
+
+    await store.flush()
+
+
+async def bench_population(results, main, size, samples, rounds):
+    # A fresh registry per size, so every run starts from empty files in the current directory
+    main.games = main.GameRegistry(
+        main.StateStore(main.create_storage_backend()),
+        lambda code: main.StateStore(main.create_storage_backend(code)),
+        main.ADMIN_USER_ID,
+        main.DEFAULT_EXCLUSION_RULES,
+    )
+    main.games.load()
+    main.media_cache = main.MediaCache(main.games.default_store)
+    await bench_storage(results, main, size, main.games.default_store)
+    await bench_handlers(results, main, size, min(samples, size), rounds)
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"participant counts (default {DEFAULT_SIZES})")
+    parser.add_argument("--samples", type=int, default=200, help="updates per handler and population")
+    parser.add_argument("--rounds", type=int, default=3, help="repetitions of start_game, broadcasts and draws")
+    parser.add_argument("--storage", choices=("json", "sqlite"), default=os.environ.get("STORAGE_BACKEND", "json"))
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    # main.py reads its configuration at import time, so it is only imported once the options are known
+    os.environ["STORAGE_BACKEND"] = args.storage
+    welcome_video = os.path.abspath("anton.mp4")
+    workdir = os.getcwd()
+    # Importing main opens the default game's storage, which must not be the real data files
+    with tempfile.TemporaryDirectory(prefix="santa-bench-") as tmp:
+        os.chdir(tmp)
+        try:
+            import main
+        finally:
+            os.chdir(workdir)
+
+    logging.getLogger().setLevel(logging.ERROR)
+    main.WELCOME_VIDEO_FILE = welcome_video
+    # The fake bot has no flood control, so only the dispatcher's own overhead is measured
+    main.broadcast_dispatcher = BroadcastDispatcher(RateLimiter(global_rate=1e9, per_chat_rate=1e9),
+                                                    max_concurrency=main.BROADCAST_CONCURRENCY)
+
+    results = Results()
+    for size in sizes:
+        bench_assignment(results, size, args.rounds)
+        bench_memory(results, size)
+        with tempfile.TemporaryDirectory(prefix="santa-bench-") as tmp:
+            os.chdir(tmp)
+            try:
+                asyncio.run(bench_population(results, main, size, args.samples, args.rounds))
+            finally:
+                os.chdir(workdir)
+        print(f"Population {size} done", file=sys.stderr)
+    results.report()
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,158 @@
+import asyncio
+import datetime
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly 30 messages per second overall and one per second per chat
+GLOBAL_RATE = 25.0
+PER_CHAT_RATE = 1.0
+
+SENT = "sent"
+FAILED = "failed"
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated_at = clock()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self) -> float:
+        """Takes a token and returns how long the caller has to wait before using it."""
+        now = self.clock()
+        self._refill(now)
+        self.tokens -= 1
+        wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.paused_until - now)
+
+    async def acquire(self) -> None:
+        wait = self.delay()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Holds back every caller for `seconds`, e.g. after a flood-control error."""
+        self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+    def is_idle(self) -> bool:
+        """Whether the bucket has refilled and is not paused, i.e. behaves exactly like a new one."""
+        now = self.clock()
+        return self.tokens + (now - self.updated_at) * self.rate >= self.capacity and self.paused_until <= now
+
+
+class RateLimiter:
+    """Global and per-chat token buckets shared by everything that sends in bulk.
+
+    Per-chat buckets are kept in order of last use, and idle ones are dropped
+    from the front as new chats come in, so only chats sent to in roughly the
+    last second stay in memory, not every chat ever broadcast to.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, per_chat_rate: float = PER_CHAT_RATE):
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        # chat_id -> TokenBucket, least recently used first
+        self.chat_buckets = {}
+
+    async def acquire(self, chat_id) -> None:
+        bucket = self.chat_buckets.pop(chat_id, None)
+        self._drop_idle_buckets()
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_rate, capacity=1.0)
+        self.chat_buckets[chat_id] = bucket
+        await bucket.acquire()
+        await self.global_bucket.acquire()
+
+    def pause(self, seconds: float) -> None:
+        self.global_bucket.pause(seconds)
+
+    def _drop_idle_buckets(self) -> None:
+        while self.chat_buckets:
+            chat_id = next(iter(self.chat_buckets))
+            if not self.chat_buckets[chat_id].is_idle():
+                break
+            del self.chat_buckets[chat_id]
+
+
+class BroadcastDispatcher:
+    """Sends one message to many chats concurrently under a RateLimiter.
+
+    `send(chat_id)` is any coroutine function, so the dispatcher can be run
+    against a fake bot. Flood-control (RetryAfter) and network errors are
+    retried; Forbidden/BadRequest fail the recipient immediately.
+    """
+
+    def __init__(self, limiter: RateLimiter, max_concurrency: int = 10, max_retries: int = 3):
+        self.limiter = limiter
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+
+    async def run(self, chat_ids, send, progress=None, on_result=None) -> dict:
+        """Returns {chat_id: SENT or FAILED}.
+
+        `on_result(chat_id, status)` is called and `progress(done, total)` is
+        awaited as soon as each recipient is done.
+        """
+        chat_ids = list(chat_ids)
+        results = {}
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def deliver(chat_id):
+            async with semaphore:
+                results[chat_id] = await self._deliver(chat_id, send)
+            if on_result is not None:
+                on_result(chat_id, results[chat_id])
+            if progress is not None:
+                await progress(len(results), len(chat_ids))
+
+        await asyncio.gather(*(deliver(chat_id) for chat_id in chat_ids))
+        return results
+
+    async def _deliver(self, chat_id, send) -> str:
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(chat_id)
+            try:
+                await send(chat_id)
+                return SENT
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                seconds = retry_after.total_seconds() if isinstance(retry_after, datetime.timedelta) else retry_after
+                logger.warning(f"Flood control hit while sending to {chat_id}, pausing for {seconds}s")
+                self.limiter.pause(seconds)
+            except (Forbidden, BadRequest) as e:
+                logger.error(f"Could not send to {chat_id}: {e}")
+                return FAILED
+            except NetworkError as e:
+                logger.warning(f"Network error while sending to {chat_id} (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logger.error(f"Could not send to {chat_id}: {e}")
+                return FAILED
+        logger.error(f"Giving up on {chat_id} after {self.max_retries + 1} attempts")
+        return FAILED
+
+
+async def send_parts(chat_id, parts: list, delivered: dict) -> None:
+    """Awaits `parts` (coroutine functions, one Bot API call each) in order for chat_id.
+
+    BroadcastDispatcher retries a failed send as a whole, so `delivered` keeps
+    {chat_id: parts already sent} across attempts and a retry resumes with the
+    part that failed instead of repeating the ones that arrived.
+    """
+    for index in range(delivered.get(chat_id, 0), len(parts)):
+        await parts[index]()
+        delivered[chat_id] = index + 1
+    delivered.pop(chat_id, None)
@@ -0,0 +1,266 @@
+import asyncio
+import csv
+import itertools
+import json
+import logging
+import os
+
+import notifications
+from storage import StateStore
+
+logger = logging.getLogger(__name__)
+
+CSV = "csv"
+JSONL = "jsonl"
+FORMATS = (CSV, JSONL)
+
+PARTICIPANT_FIELDS = ("chat_id", "user_id", "name", "username", "wishlist")
+ASSIGNMENT_FIELDS = ("giver_user_id", "giver_name", "receiver_user_id", "receiver_name")
+# Records handled between yields to the event loop, so a big file never blocks other chats for long
+CHUNK_SIZE = 1000
+
+
+class ImportRejected(Exception):
+    """The file cannot be imported at all; the message is shown to the admin."""
+
+
+class ImportResult:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.added = 0
+        self.updated = 0
+        self.duplicates = 0
+        # (line number, reason) of every record that was not imported
+        self.errors = []
+
+    def error_report(self) -> str:
+        return "".join(f"Строка {line}: {reason}\n" for line, reason in self.errors)
+
+
+def format_for(file_name: str):
+    """Returns CSV or JSONL based on the file extension, None for anything else."""
+    extension = os.path.splitext(file_name or "")[1].lower().lstrip(".")
+    if extension == "ndjson":
+        return JSONL
+    return extension if extension in FORMATS else None
+
+
+class _RecordWriter:
+    def __init__(self, f, fmt: str, fields):
+        self.f = f
+        self.fields = fields
+        self.csv_writer = None
+        if fmt == CSV:
+            self.csv_writer = csv.DictWriter(f, fieldnames=fields)
+            self.csv_writer.writeheader()
+
+    def write(self, record: dict) -> None:
+        if self.csv_writer is not None:
+            self.csv_writer.writerow({field: "" if record[field] is None else record[field] for field in self.fields})
+        else:
+            self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+async def export_participants(store: StateStore, path: str, fmt: str) -> int:
+    """Writes the store's participants to `path` record by record; returns how many were written."""
+    count = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = _RecordWriter(f, fmt, PARTICIPANT_FIELDS)
+        # Only the keys are copied; records that disappear while we yield are skipped
+        for chat_id in list(store.participants):
+            info = store.get_participant(chat_id)
+            if info is None:
+                continue
+            writer.write({"chat_id": chat_id, "user_id": info["user_id"], "name": info.get("name"),
+                          "username": info.get("username"), "wishlist": info.get("wishlist")})
+            count += 1
+            if count % CHUNK_SIZE == 0:
+                await asyncio.sleep(0)
+    return count
+
+
+async def export_assignments(store: StateStore, path: str, fmt: str) -> int:
+    count = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = _RecordWriter(f, fmt, ASSIGNMENT_FIELDS)
+        for giver_user_id, receiver_user_id in list(store.assignments.items()):
+            giver = store.participant_by_user_id(giver_user_id) or {}
+            receiver = store.participant_by_user_id(receiver_user_id) or {}
+            writer.write({"giver_user_id": giver_user_id, "giver_name": giver.get("name"),
+                          "receiver_user_id": receiver_user_id, "receiver_name": receiver.get("name")})
+            count += 1
+            if count % CHUNK_SIZE == 0:
+                await asyncio.sleep(0)
+    return count
+
+
+def read_records(path: str, fmt: str):
+    """Yields (line number, record dict or None if the line is not a valid record) one at a time.
+
+    Raises ImportRejected if the file as a whole cannot be read: it is not
+    UTF-8 (e.g. a CSV saved by Excel in cp1251) or is not valid CSV.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            if fmt == CSV:
+                reader = csv.DictReader(f)
+                try:
+                    for record in reader:
+                        yield reader.line_num, record
+                except csv.Error as e:
+                    raise ImportRejected(f"Файл не удалось прочитать как CSV после строки {reader.line_num} ({e}).")
+                return
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                yield line_number, record if isinstance(record, dict) else None
+    except UnicodeDecodeError:
+        raise ImportRejected("Файл не в кодировке UTF-8. Сохрани его как «CSV UTF-8» и отправь еще раз.")
+
+
+async def import_file(store: StateStore, path: str, fmt: str, exclusions: dict = None) -> ImportResult:
+    """Imports participants or, if the records have giver_user_id, assignments from a CSV/JSONL file.
+
+    `exclusions` is the game's compiled giver -> forbidden receivers map, which imported pairs must respect.
+    """
+    records = read_records(path, fmt)
+    first = next(records, None)
+    if first is None:
+        raise ImportRejected("Файл пустой.")
+    records = itertools.chain([first], records)
+    if first[1] is not None and "giver_user_id" in first[1]:
+        return await import_assignments(store, records, exclusions)
+    return await import_participants(store, records)
+
+
+def _text(record: dict, field: str):
+    value = record.get(field)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _user_id(value):
+    # Telegram ids are integers; negative ones are group chats.
+    # isdecimal, unlike isdigit, rejects characters such as "²" that int() cannot parse
+    if value is None or not value.lstrip("-").isdecimal():
+        return None
+    return str(int(value))
+
+
+async def import_participants(store: StateStore, records) -> ImportResult:
+    """Adds or updates participants once the whole file has been read and checked.
+
+    Records are matched to existing participants through the store's user_id
+    index, so re-importing an export updates in place. A user_id that appears
+    twice in the file is only taken the first time. A file that turns out to
+    be unreadable halfway changes nothing; the accepted records are applied
+    together, without yielding, so handlers see none or all of them.
+    """
+    if store.game_started:
+        raise ImportRejected("Игра уже началась, добавлять участников из файла нельзя.")
+    result = ImportResult("participants")
+    seen_user_ids = set()
+    # (line number, user_id, chat_id from the file, name, username, wishlist) of every valid record
+    accepted = []
+    for count, (line_number, record) in enumerate(records, start=1):
+        if count % CHUNK_SIZE == 0:
+            await asyncio.sleep(0)
+        if record is None:
+            result.errors.append((line_number, "не удалось разобрать запись"))
+            continue
+        user_id = _user_id(_text(record, "user_id"))
+        name = _text(record, "name")
+        if user_id is None:
+            result.errors.append((line_number, "нет user_id или он не числовой"))
+            continue
+        if name is None:
+            result.errors.append((line_number, "пустое имя"))
+            continue
+        if user_id in seen_user_ids:
+            result.duplicates += 1
+            result.errors.append((line_number, f"user_id {user_id} уже встречался в файле"))
+            continue
+        seen_user_ids.add(user_id)
+        username = _text(record, "username")
+        accepted.append((line_number, user_id, _user_id(_text(record, "chat_id")), name,
+                         username.lstrip("@") if username else None, _text(record, "wishlist")))
+
+    # The game may have been started while the file was read
+    if store.game_started:
+        raise ImportRejected("Игра уже началась, добавлять участников из файла нельзя.")
+    for line_number, user_id, file_chat_id, name, username, wishlist in accepted:
+        chat_id = store.chat_id_for_user(user_id)
+        if chat_id is None:
+            chat_id = file_chat_id or user_id
+            if store.is_participant(chat_id):
+                result.errors.append((line_number, f"chat_id {chat_id} уже занят другим участником"))
+                continue
+            result.added += 1
+        else:
+            result.updated += 1
+        store.set_name(chat_id, user_id, name, username)
+        if wishlist is not None:
+            store.set_wishlist(chat_id, wishlist)
+    result.errors.sort()
+    logger.info(f"Imported participants: {result.added} added, {result.updated} updated, "
+                f"{len(result.errors)} rejected")
+    return result
+
+
+async def import_assignments(store: StateStore, records, exclusions: dict = None) -> ImportResult:
+    """Replaces the assignments with the file's pairs, but only if every pair is valid.
+
+    Givers and receivers must be participants with a wishlist, nobody gives to
+    themselves or to someone the exclusion rules forbid, and every giver is
+    also exactly one other giver's receiver. Like a fresh draw, the imported
+    pairs start out with every giver's notification pending.
+    """
+    exclusions = exclusions or {}
+    result = ImportResult("assignments")
+    without_wishlist = {store.participants[chat_id]["user_id"] for chat_id in store.missing_wishlists()}
+    assignments = {}
+    receivers = set()
+    for count, (line_number, record) in enumerate(records, start=1):
+        if count % CHUNK_SIZE == 0:
+            await asyncio.sleep(0)
+        if record is None:
+            result.errors.append((line_number, "не удалось разобрать запись"))
+            continue
+        giver = _user_id(_text(record, "giver_user_id"))
+        receiver = _user_id(_text(record, "receiver_user_id"))
+        if giver is None or receiver is None:
+            result.errors.append((line_number, "нет giver_user_id/receiver_user_id или они не числовые"))
+        elif store.participant_by_user_id(giver) is None or store.participant_by_user_id(receiver) is None:
+            result.errors.append((line_number, "даритель или получатель не участвует в игре"))
+        elif giver in without_wishlist or receiver in without_wishlist:
+            result.errors.append((line_number, "даритель или получатель еще не написал письмо деду морозу"))
+        elif giver == receiver:
+            result.errors.append((line_number, "участник не может дарить подарок сам себе"))
+        elif receiver in exclusions.get(giver, ()):
+            result.errors.append((line_number, "пара запрещена правилами исключений"))
+        elif giver in assignments:
+            result.duplicates += 1
+            result.errors.append((line_number, f"у дарителя {giver} уже есть подопечный"))
+        elif receiver in receivers:
+            result.duplicates += 1
+            result.errors.append((line_number, f"у получателя {receiver} уже есть Санта"))
+        else:
+            assignments[giver] = receiver
+            receivers.add(receiver)
+    if not result.errors and receivers != assignments.keys():
+        result.errors.append((0, "каждый даритель должен быть и получателем, пары не образуют замкнутые цепочки"))
+    if result.errors:
+        return result
+    store.set_assignments(assignments)
+    # The previous draw's delivery statuses no longer apply
+    notifications.render_all(store)
+    notifications.mark_all_pending(store)
+    result.added = len(assignments)
+    logger.info(f"Imported {len(assignments)} assignments")
+    return result
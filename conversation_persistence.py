@@ -0,0 +1,98 @@
+import copy
+import json
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from storage import StateStore
+
+# Store sections holding ConversationHandler states and context.user_data
+CONVERSATIONS_SECTION = "conversations"
+USER_DATA_SECTION = "user_data"
+
+
+class StorePersistence(BasePersistence):
+    """PTB persistence for conversation states and user_data, kept in StateStore sections.
+
+    Every update only changes the in-memory sections; the store's backend
+    writes them behind in batches together with the participants, so
+    handlers never wait for the disk. Chat data, bot data and callback data
+    are not used by the bot and are not stored. Conversation keys are tuples
+    and are stored as JSON arrays.
+    """
+
+    def __init__(self, store: StateStore, update_interval: float = 5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+
+    async def get_conversations(self, name: str) -> dict:
+        states = self.store.section(CONVERSATIONS_SECTION).get(name, {})
+        return {tuple(json.loads(key)): state for key, state in states.items()}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        conversations = self.store.section(CONVERSATIONS_SECTION)
+        states = conversations.setdefault(name, {})
+        json_key = json.dumps(list(key))
+        if new_state is None:
+            if states.pop(json_key, None) is None:
+                return
+        elif states.get(json_key) == new_state:
+            return
+        else:
+            states[json_key] = new_state
+        self.store.section_changed(CONVERSATIONS_SECTION)
+
+    async def get_user_data(self) -> dict:
+        return {int(user_id): copy.deepcopy(data)
+                for user_id, data in self.store.section(USER_DATA_SECTION).items()}
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        user_data = self.store.section(USER_DATA_SECTION)
+        if not data:
+            # Most users never have any; keep them out of the file
+            if user_data.pop(str(user_id), None) is not None:
+                self.store.section_changed(USER_DATA_SECTION)
+            return
+        if user_data.get(str(user_id)) == data:
+            return
+        user_data[str(user_id)] = copy.deepcopy(data)
+        self.store.section_changed(USER_DATA_SECTION)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if self.store.section(USER_DATA_SECTION).pop(str(user_id), None) is not None:
+            self.store.section_changed(USER_DATA_SECTION)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        await self.store.flush()
@@ -0,0 +1,90 @@
+from storage import StateStore
+
+# Rule types. Rules are plain dicts so they can be stored with the game's metadata.
+PAIR = "pair"        # the two never give to each other
+GROUP = "group"      # nobody in the group gives to another member of the same group
+HISTORY = "history"  # nobody gets the receiver they had in an earlier draw
+
+
+def pair_rule(first: str, second: str) -> dict:
+    return {"type": PAIR, "members": [first, second]}
+
+
+def group_rule(name: str, members) -> dict:
+    return {"type": GROUP, "name": name, "members": list(members)}
+
+
+def history_rule(label: str, assignments: dict) -> dict:
+    return {"type": HISTORY, "label": label, "assignments": dict(assignments)}
+
+
+def describe(rule: dict) -> str:
+    if rule["type"] == PAIR:
+        return f"{rule['members'][0]} и {rule['members'][1]} не дарят друг другу"
+    if rule["type"] == GROUP:
+        return f"группа «{rule['name']}» ({len(rule['members'])}): {', '.join(rule['members'])}"
+    return f"не повторять пары игры «{rule['label']}» ({len(rule['assignments'])} пар)"
+
+
+def resolve(store: StateStore, reference: str) -> set:
+    """Returns the user_ids a rule member refers to: a user_id, an @username or a display name.
+
+    A number is a user_id unless no participant has that id and someone's
+    display name is that number. For rules written before usernames were
+    indexed, an @name that matches no username is also looked up as a
+    display name.
+    """
+    reference = reference.strip()
+    # isdecimal, unlike isdigit, rejects characters such as "²" that int() cannot parse
+    if reference.lstrip("-").isdecimal():
+        user_id = str(int(reference))
+        if store.participant_by_user_id(user_id) is None:
+            return store.user_ids_by_name(reference) or {user_id}
+        return {user_id}
+    if reference.startswith("@"):
+        return store.user_ids_by_username(reference[1:]) or store.user_ids_by_name(reference[1:])
+    return store.user_ids_by_name(reference)
+
+
+def unresolved(rules, store: StateStore) -> list:
+    """Returns (rule number, member) for every rule member that matches no participant."""
+    return [(number, reference)
+            for number, rule in enumerate(rules, start=1) if rule["type"] != HISTORY
+            for reference in rule["members"] if not resolve(store, reference)]
+
+
+def compile_rules(rules, store: StateStore) -> dict:
+    """Compiles rules into the giver -> set(forbidden receivers) map draw_assignments expects.
+
+    Members of exactly one group and no other rule share that group's set
+    instead of getting a copy, so a large team costs one set, not one per member.
+    """
+    extra = {}
+    groups_of = {}
+
+    for rule in rules:
+        if rule["type"] == HISTORY:
+            for giver, receiver in rule["assignments"].items():
+                extra.setdefault(giver, set()).add(receiver)
+            continue
+        # Members that match nobody yet resolve to nothing; /status and /exclude report them, not every compile
+        resolved = [resolve(store, reference) for reference in rule["members"]]
+        if rule["type"] == PAIR:
+            first, second = resolved
+            for u1_id in first:
+                extra.setdefault(u1_id, set()).update(second)
+            for u2_id in second:
+                extra.setdefault(u2_id, set()).update(first)
+        else:
+            members = frozenset().union(*resolved)
+            for user_id in members:
+                groups_of.setdefault(user_id, []).append(members)
+
+    exclusions = {}
+    for user_id in extra.keys() | groups_of.keys():
+        groups = groups_of.get(user_id, [])
+        if len(groups) == 1 and user_id not in extra:
+            exclusions[user_id] = groups[0]
+        else:
+            exclusions[user_id] = frozenset().union(extra.get(user_id, ()), *groups)
+    return exclusions
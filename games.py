@@ -0,0 +1,160 @@
+import logging
+import os
+import secrets
+
+import exclusions
+from storage import StateStore
+
+logger = logging.getLogger(__name__)
+
+# The game that existed before multi-game support; it keeps the original files
+DEFAULT_GAME = "default"
+# Sections of the default store that describe all games (metadata) and which game each chat is in
+GAMES_SECTION = "games"
+MEMBERSHIPS_SECTION = "memberships"
+# Every game other than the default one keeps its state in its own subdirectory of this, next to the default files
+GAMES_DIR = "games"
+
+
+def game_file(data_file: str, code: str) -> str:
+    """Returns where game `code` keeps `data_file`, creating the game's directory if needed.
+
+    The default game uses `data_file` itself, every other game a file of the
+    same name in <directory of data_file>/games/<code>/, so an absolute path
+    such as /var/data/santa.db still gives every game its own file.
+    """
+    if code == DEFAULT_GAME:
+        return data_file
+    directory = os.path.join(os.path.dirname(data_file), GAMES_DIR, code)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, os.path.basename(data_file))
+
+
+class Game:
+    """One independent Secret Santa game with its own admins, exclusions and state.
+
+    The bot owner (TELEGRAM_ADMIN_ID) is an admin of every game.
+    """
+
+    def __init__(self, code: str, info: dict, store: StateStore, owner_id: int):
+        self.code = code
+        self.info = info
+        self.store = store
+        self.owner_id = owner_id
+
+    @property
+    def title(self) -> str:
+        return self.info.get("title") or "Тайный Санта"
+
+    @property
+    def admins(self) -> set:
+        return {int(user_id) for user_id in self.info.get("admins", [])}
+
+    @property
+    def exclusion_rules(self) -> list:
+        """The game's exclusion rules (see exclusions.py); mutate in place, then call GameRegistry.info_changed."""
+        rules = self.info.get("exclusion_rules")
+        if rules is None:
+            # Games saved before the rules engine only had pairs of usernames
+            rules = self.info["exclusion_rules"] = [
+                exclusions.pair_rule(first, second) for first, second in self.info.get("excluded_pairs", [])
+            ]
+        return rules
+
+    def is_admin(self, user_id: int) -> bool:
+        return user_id == self.owner_id or user_id in self.admins
+
+    def holds(self, chat_id: str) -> bool:
+        """Whether the chat plays in this game and the game has started.
+
+        Such a chat stays in the game: switching it to another one would cut
+        it off from its giftee, its Santa and the relay between them.
+        """
+        return self.store.game_started and self.store.is_participant(chat_id)
+
+
+class GameRegistry:
+    """Keeps every game's state in its own shard and maps chats to games.
+
+    Game metadata and chat memberships live in sections of the default game's
+    store. Other games' stores are created by `create_store(code)` and only
+    loaded the first time that game is touched, so working with one game
+    never reads or writes another game's participants or assignments.
+    """
+
+    def __init__(self, default_store: StateStore, create_store, owner_id: int, default_exclusion_rules=()):
+        self.default_store = default_store
+        self.create_store = create_store
+        self.owner_id = owner_id
+        self.default_exclusion_rules = default_exclusion_rules
+        self._games = {}
+
+    def load(self) -> None:
+        self.default_store.load()
+        games = self.default_store.section(GAMES_SECTION)
+        # The default game starts out with the exclusions hard-coded in main.py; admins edit them at runtime
+        info = games.setdefault(DEFAULT_GAME, {
+            "title": "Тайный Санта", "admins": [], "exclusion_rules": list(self.default_exclusion_rules),
+        })
+        self._games = {DEFAULT_GAME: Game(DEFAULT_GAME, info, self.default_store, self.owner_id)}
+
+    def get(self, code: str):
+        game = self._games.get(code)
+        if game is None:
+            info = self.default_store.section(GAMES_SECTION).get(code)
+            if info is None:
+                return None
+            store = self.create_store(code)
+            store.load()
+            game = self._games[code] = Game(code, info, store, self.owner_id)
+        return game
+
+    def code_for_chat(self, chat_id: str) -> str:
+        """Returns the code of the chat's current game without loading that game's store."""
+        code = self.default_store.section(MEMBERSHIPS_SECTION).get(chat_id, DEFAULT_GAME)
+        return code if code in self.default_store.section(GAMES_SECTION) else DEFAULT_GAME
+
+    def for_chat(self, chat_id: str) -> Game:
+        return self.get(self.code_for_chat(chat_id))
+
+    def join(self, chat_id: str, code: str):
+        """Makes `code` the chat's current game; returns None for an unknown code."""
+        game = self.get(code)
+        if game is None:
+            return None
+        memberships = self.default_store.section(MEMBERSHIPS_SECTION)
+        if memberships.get(chat_id, DEFAULT_GAME) != code:
+            memberships[chat_id] = code
+            self.default_store.section_changed(MEMBERSHIPS_SECTION)
+        return game
+
+    def create(self, title: str, admin_user_id: int) -> Game:
+        games = self.default_store.section(GAMES_SECTION)
+        code = secrets.token_urlsafe(6)
+        while code in games or code == DEFAULT_GAME:
+            code = secrets.token_urlsafe(6)
+        games[code] = {"title": title, "admins": [admin_user_id], "creator": admin_user_id, "exclusion_rules": []}
+        self.default_store.section_changed(GAMES_SECTION)
+        logger.info(f"Created game {code} ({title}) for admin {admin_user_id}")
+        return self.get(code)
+
+    def created_by(self, user_id: int) -> int:
+        """Returns how many games the user has created."""
+        return sum(1 for info in self.default_store.section(GAMES_SECTION).values() if info.get("creator") == user_id)
+
+    def info_changed(self, game: Game) -> None:
+        self.default_store.section_changed(GAMES_SECTION)
+
+    def all_codes(self) -> list:
+        return list(self.default_store.section(GAMES_SECTION))
+
+    def info(self, code: str) -> dict:
+        """Returns a game's metadata without loading its store; check it before get() when scanning all games."""
+        return self.default_store.section(GAMES_SECTION)[code]
+
+    def loaded_games(self) -> list:
+        return list(self._games.values())
+
+    async def flush(self) -> None:
+        for game in self.loaded_games():
+            await game.store.flush()
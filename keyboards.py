@@ -0,0 +1,82 @@
+from telegram import KeyboardButton, ReplyKeyboardMarkup
+from telegram.ext import filters
+
+# Per-chat states that decide which main keyboard is shown (see StateStore.chat_state)
+NOT_JOINED = "not_joined"
+JOINED = "joined"
+IN_GAME = "in_game"
+IN_GAME_WITH_ASSIGNMENT = "in_game_with_assignment"
+
+# Button actions; handlers are routed by action, never by label
+JOIN = "join"
+RENAME = "rename"
+WISHLIST = "wishlist"
+MY_SANTA = "my_santa"
+WRITE_SANTA = "write_santa"
+WRITE_GIFTEE = "write_giftee"
+CANCEL = "cancel"
+BROADCAST_TEXT = "broadcast_text"
+BROADCAST_PHOTO = "broadcast_photo"
+BROADCAST_VIDEO = "broadcast_video"
+CONFIRM = "confirm"
+DECLINE = "decline"
+
+# The one place button labels are defined: action -> labels. The first label is the one shown; the others
+# are still understood, e.g. from keyboards sent before a label changed or labels in another language
+BUTTONS = {
+    JOIN: ("🎅 Присоединиться к игре 🎄",),
+    RENAME: ("✏️ Изменить имя",),
+    WISHLIST: ("📝 Изменить письмо деду морозу 🎁", "📝 Написать письмо деду морозу 🎁"),
+    MY_SANTA: ("🎁 Мой Санта 🎅",),
+    WRITE_SANTA: ("✉️ Написать Санте",),
+    WRITE_GIFTEE: ("✉️ Написать подопечному",),
+    CANCEL: ("Отмена",),
+    BROADCAST_TEXT: ("Текст",),
+    BROADCAST_PHOTO: ("Фото",),
+    BROADCAST_VIDEO: ("Видео",),
+    CONFIRM: ("Да, отправить",),
+    DECLINE: ("Нет, отмена",),
+}
+# label -> action; routing a message is one lookup here, however many buttons and labels there are
+ACTIONS = {text: action for action, labels in BUTTONS.items() for text in labels}
+
+
+def label(action: str) -> str:
+    return BUTTONS[action][0]
+
+
+def action_for(text):
+    """Returns the action of the button with this label, or None if the text is not a button."""
+    return ACTIONS.get(text)
+
+
+class Button(filters.MessageFilter):
+    """Matches messages that are a press of one of the given buttons."""
+
+    def __init__(self, *actions: str):
+        self.actions = frozenset(actions)
+        super().__init__(name=f"Button({', '.join(actions)})")
+
+    def filter(self, message) -> bool:
+        return ACTIONS.get(message.text) in self.actions
+
+
+def _keyboard(rows, one_time_keyboard: bool = False) -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup([[KeyboardButton(label(action)) for action in row] for row in rows],
+                               one_time_keyboard=one_time_keyboard, resize_keyboard=True)
+
+
+# Telegram objects are frozen after construction, so these markups are built once and shared
+MAIN_KEYBOARDS = {
+    NOT_JOINED: _keyboard([[JOIN]]),
+    # Editing name and wishlist is only allowed before the game has started
+    JOINED: _keyboard([[RENAME, WISHLIST]]),
+    IN_GAME: _keyboard([]),
+    IN_GAME_WITH_ASSIGNMENT: _keyboard([[MY_SANTA], [WRITE_SANTA, WRITE_GIFTEE]]),
+}
+
+CANCEL_KEYBOARD = _keyboard([[CANCEL]], one_time_keyboard=True)
+
+BROADCAST_TYPE_KEYBOARD = _keyboard([[BROADCAST_TEXT, BROADCAST_PHOTO, BROADCAST_VIDEO]], one_time_keyboard=True)
+
+BROADCAST_CONFIRM_KEYBOARD = _keyboard([[CONFIRM, DECLINE]], one_time_keyboard=True)
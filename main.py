@@ -1,12 +1,38 @@
+import asyncio
+import datetime
+import hmac
 import logging
 import json
 import os
-import random
-from telegram import Update, InputFile, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+import secrets
+import signal
+import tempfile
+import time
+from http import HTTPStatus
+from zoneinfo import ZoneInfo
+from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
 )
 
+from assignment import AssignmentError, add_participant, draw_assignments, remove_participant
+import bulk_io
+import exclusions
+from broadcast import FAILED, SENT, BroadcastDispatcher, RateLimiter
+from games import DEFAULT_GAME, Game, GameRegistry, game_file
+from conversation_persistence import CONVERSATIONS_SECTION, StorePersistence
+import keyboards
+import metrics
+from media_cache import MediaCache
+import notifications
+from persistence import JsonBackend
+import relay
+import reminders
+from sqlite_storage import SqliteBackend
+from storage import StateStore
+from update_processor import PerChatUpdateProcessor
+from webserver import HttpServer, Response
+
 # Enable logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -26,6 +52,23 @@ if not ADMIN_USER_ID:
 
 PARTICIPANTS_FILE = "participants.json"
 ASSIGNMENTS_FILE = "assignments.json"
+WELCOME_VIDEO_FILE = "anton.mp4"
+# "json" (default) keeps the files above, "sqlite" uses SQLITE_DB_FILE (see migrate_to_sqlite.py)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")
+SQLITE_DB_FILE = os.environ.get("SQLITE_DB_FILE", "santa.db")
+# Who may run /new_game: "owner" (default) is only TELEGRAM_ADMIN_ID, "anyone" is every user, each up to
+# MAX_GAMES_PER_USER games, since every game gets its own files on disk
+GAME_CREATORS = os.environ.get("GAME_CREATORS", "owner")
+MAX_GAMES_PER_USER = int(os.environ.get("MAX_GAMES_PER_USER", "3"))
+# Most rendered giftee messages kept in memory per game; 0 keeps all. Bound it for very large sqlite games,
+# whose wishlists otherwise stay on disk until they are needed
+GIFTEE_CACHE_SIZE = int(os.environ.get("GIFTEE_CACHE_SIZE", "0"))
+
+def create_storage_backend(code: str = DEFAULT_GAME):
+    # The original single game keeps using the configured files, the others get their own copies (see game_file)
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteBackend(game_file(SQLITE_DB_FILE, code))
+    return JsonBackend(game_file(PARTICIPANTS_FILE, code), game_file(ASSIGNMENTS_FILE, code))
 
 # List of (username1, username2) pairs that should not be assigned to each other
 # Make sure to include the '@' symbol for usernames.
@@ -36,40 +79,111 @@ EXCLUDED_PAIRS_USERNAMES = [
     ("@plzcult", "@LevaMaster"),
     ("@plzcult", "@BA_ANSHEE")
 ]
+# Initial exclusion rules of the default game; afterwards admins manage them with /exclude and friends
+DEFAULT_EXCLUSION_RULES = [exclusions.pair_rule(first, second) for first, second in EXCLUDED_PAIRS_USERNAMES]
+
+# All games are loaded lazily in main(); each one's participants and assignments are served from memory
+games = GameRegistry(
+    StateStore(create_storage_backend(), GIFTEE_CACHE_SIZE),
+    lambda code: StateStore(create_storage_backend(code), GIFTEE_CACHE_SIZE),
+    ADMIN_USER_ID,
+    DEFAULT_EXCLUSION_RULES,
+)
+# Telegram file_ids of already uploaded media are bot-wide, so they live in the default game's store
+media_cache = MediaCache(games.default_store)
+
+# "derangement" (default) draws any valid pairing, "cycle" joins everyone into a single gift circle
+ASSIGNMENT_MODE = os.environ.get("ASSIGNMENT_MODE", "derangement")
+
+# Maximum number of broadcast messages in flight at once
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "10"))
+# Shared by every bulk sender so they respect Telegram's limits together
+rate_limiter = RateLimiter()
+broadcast_dispatcher = BroadcastDispatcher(rate_limiter, max_concurrency=BROADCAST_CONCURRENCY)
+# Anonymous messages between Santas and giftees are delivered from here, see relay.py
+RELAY_WORKERS = int(os.environ.get("RELAY_WORKERS", "4"))
+relay_outbox = relay.RelayOutbox(broadcast_dispatcher, workers=RELAY_WORKERS)
+
+# "polling" (default) or "webhook"; webhook mode serves updates from the embedded HTTP server
+RUN_MODE = os.environ.get("RUN_MODE", "polling")
+# Public base URL of this service; Render provides RENDER_EXTERNAL_URL for web services
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL") or os.environ.get("RENDER_EXTERNAL_URL")
+WEBHOOK_PATH = "/telegram"
+# Telegram echoes this in every webhook request; a random one is fine since we register the webhook ourselves.
+# A configured one may only contain A-Z, a-z, 0-9, _ and -
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+PORT = int(os.environ.get("PORT", "10000"))
+# The handlers only ever look at messages
+ALLOWED_UPDATES = [Update.MESSAGE]
+
+# Updates from different chats are handled concurrently, at most this many at a time
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "32"))
+
+# Prometheus metrics are served at http://METRICS_HOST:METRICS_PORT/metrics; an empty METRICS_PORT disables them
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.environ.get("METRICS_PORT", "9464")
+# Updates slower than this many seconds are logged; PROFILE_SAMPLE_RATE of all updates also run under cProfile
+SLOW_UPDATE_SECONDS = float(os.environ.get("SLOW_UPDATE_SECONDS", "1.0"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+metrics_server = HttpServer(METRICS_HOST, int(METRICS_PORT)) if METRICS_PORT else None
+
+# Participants without a name or wishlist are reminded at most once per REMINDER_INTERVAL_HOURS (0 disables);
+# the job looks for them every REMINDER_CHECK_MINUTES and sends at most REMINDER_BATCH_SIZE reminders per run
+REMINDER_INTERVAL_HOURS = float(os.environ.get("REMINDER_INTERVAL_HOURS", "24"))
+REMINDER_CHECK_MINUTES = float(os.environ.get("REMINDER_CHECK_MINUTES", "30"))
+REMINDER_BATCH_SIZE = int(os.environ.get("REMINDER_BATCH_SIZE", "200"))
+# No reminders between these hours in REMINDER_TIMEZONE, e.g. "22-9"; empty means any time
+REMINDER_QUIET_HOURS = reminders.parse_quiet_hours(os.environ.get("REMINDER_QUIET_HOURS", "22-9"))
+REMINDER_TIMEZONE = ZoneInfo(os.environ.get("REMINDER_TIMEZONE", "Europe/Moscow"))
 
 # States for conversation handler
 JOIN_NAME, WISHLIST_TEXT = range(2)
 BROADCAST_TYPE, BROADCAST_CONTENT, BROADCAST_CONFIRM = range(2, 5)
+# What the admin is asked to send for each broadcast type button
+BROADCAST_CONTENT_NAMES = {keyboards.BROADCAST_TEXT: "текст", keyboards.BROADCAST_PHOTO: "фото",
+                           keyboards.BROADCAST_VIDEO: "видео"}
+RELAY_MESSAGE = 5
 
 def get_main_keyboard(chat_id: str) -> ReplyKeyboardMarkup:
-    keyboard_buttons = []
-    data = load_data()
-    assignments_data = load_assignments()
+    return keyboards.MAIN_KEYBOARDS[games.for_chat(chat_id).store.chat_state(chat_id)]
 
-    game_started = bool(assignments_data["assignments"])
+async def resolve_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Returns the chat's game, switching to the one named in a /start or /join payload first.
 
-    if chat_id not in data["participants"]:
-        keyboard_buttons.append([KeyboardButton("🎅 Присоединиться к игре 🎄")])
-    else:
-        participant_info = data["participants"][chat_id]
-        # Allow editing name and wishlist only if the game has not started
-        if not game_started:
-            keyboard_buttons.append([KeyboardButton("✏️ Изменить имя"), KeyboardButton("📝 Изменить письмо деду морозу 🎁")])
-        
-        if game_started and chat_id in assignments_data["assignments"]:
-            keyboard_buttons.append([KeyboardButton("🎁 Мой Санта 🎅")])
+    Invite links open the bot with /start <game code>. Returns None (after
+    telling the user) if the code is unknown or the chat plays in a game
+    that has already started.
+    """
+    chat_id = str(update.effective_chat.id)
+    current = games.for_chat(chat_id)
+    if not context.args or context.args[0] == current.code:
+        return current
+    if current.holds(chat_id):
+        await reply_game_held(update, current)
+        return None
+    game = games.join(chat_id, context.args[0])
+    if game is None:
+        await update.message.reply_text("Игра с таким кодом не найдена. Проверь ссылку-приглашение.",
+                                        reply_markup=get_main_keyboard(chat_id))
+    return game
 
-    return ReplyKeyboardMarkup(keyboard_buttons, one_time_keyboard=False, resize_keyboard=True)
+async def reply_game_held(update: Update, game: Game) -> None:
+    chat_id = str(update.effective_chat.id)
+    await update.message.reply_text(f"Ты участвуешь в игре «{game.title}», и она уже началась. "
+                                    "Пока она идет, перейти в другую игру нельзя.",
+                                    reply_markup=get_main_keyboard(chat_id))
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Sends a video and asks for the name when the command /start is issued."""
     user = update.effective_user
     chat_id = str(update.effective_chat.id)
-    data = load_data()
-    assignments_data = load_assignments()
-    game_started = bool(assignments_data["assignments"])
+    game = await resolve_game(update, context)
+    if game is None:
+        return ConversationHandler.END
+    store = game.store
+    game_started = store.game_started
 
-    if chat_id in data["participants"]:
+    if store.is_participant(chat_id):
         if game_started:
             await update.message.reply_text(
                 "Привет! Игра уже началась, поэтому изменения имени и письма деду морозу больше невозможны.",
@@ -78,15 +192,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             return ConversationHandler.END
         else:
             await update.message.reply_text(
-                """Привет! Твоя текущая информация сохранена. Если хочешь изменить свое имя, просто нажми "✏️ Изменить имя". Если хочешь изменить письмо, нажми "📝 Изменить письмо деду морозу 🎁".""",
+                f"Привет! Твоя текущая информация сохранена. Если хочешь изменить свое имя, просто нажми "
+                f"\"{keyboards.label(keyboards.RENAME)}\". Если хочешь изменить письмо, нажми "
+                f"\"{keyboards.label(keyboards.WISHLIST)}\".",
                 reply_markup=get_main_keyboard(chat_id)
             )
             return ConversationHandler.END
 
     # Send the video
     try:
-        with open("anton.mp4", 'rb') as video_file:
-            await context.bot.send_video(chat_id=chat_id, video=InputFile(video_file))
+        await media_cache.send_local_file(
+            WELCOME_VIDEO_FILE, lambda video: context.bot.send_video(chat_id=chat_id, video=video)
+        )
     except FileNotFoundError:
         logger.error("anton.mp4 not found. Make sure the video file is in the same directory as main.py")
         await update.message.reply_text("Извини, я не могу найти видеофайл. Пожалуйста, сообщи администратору.")
@@ -94,7 +211,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     await update.message.reply_html(
         f"Привет, как тебя зовут? 🎅🎁🎄 (Это имя увидят другие участники)",
-        reply_markup=ReplyKeyboardMarkup([[KeyboardButton("Отмена")]], one_time_keyboard=True, resize_keyboard=True)
+        reply_markup=keyboards.CANCEL_KEYBOARD
     )
     return JOIN_NAME
 
@@ -106,22 +223,25 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def join(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the conversation for joining the Secret Santa game."""
     chat_id = str(update.effective_chat.id)
-    data = load_data()
-    assignments_data = load_assignments()
-    game_started = bool(assignments_data["assignments"])
+    game = await resolve_game(update, context)
+    if game is None:
+        return ConversationHandler.END
+    store = game.store
+    game_started = store.game_started
 
-    if chat_id in data["participants"]:
+    if store.is_participant(chat_id):
         if game_started:
             await update.message.reply_text("Игра уже началась, поэтому изменения имени и письма деду морозу больше невозможны.",
                                             reply_markup=get_main_keyboard(chat_id))
             return ConversationHandler.END
-        else:
-            await update.message.reply_text("""Ты уже зарегистрирован! Если хочешь изменить имя, "
-                                        "используй кнопку "✏️ Изменить имя". Если хочешь изменить письмо деду морозу, используй кнопку "📝 Изменить письмо деду морозу 🎁".""",
-                                        reply_markup=get_main_keyboard(chat_id))
+        elif keyboards.action_for(update.message.text) != keyboards.RENAME:
+            await update.message.reply_text(f"Ты уже зарегистрирован! Если хочешь изменить имя, используй кнопку "
+                                            f"\"{keyboards.label(keyboards.RENAME)}\". Если хочешь изменить письмо "
+                                            f"деду морозу, используй кнопку \"{keyboards.label(keyboards.WISHLIST)}\".",
+                                            reply_markup=get_main_keyboard(chat_id))
             return ConversationHandler.END
     await update.message.reply_text("Привет! Как тебя зовут? (Это имя увидят другие участники)",
-                                    reply_markup=ReplyKeyboardMarkup([[KeyboardButton("Отмена")]], one_time_keyboard=True, resize_keyboard=True))
+                                    reply_markup=keyboards.CANCEL_KEYBOARD)
     return JOIN_NAME
 
 async def receive_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -133,17 +253,10 @@ async def receive_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
     if not name:
         await update.message.reply_text("Имя не может быть пустым. Пожалуйста, введи свое имя.",
-                                        reply_markup=ReplyKeyboardMarkup([[KeyboardButton("Отмена")]], one_time_keyboard=True, resize_keyboard=True))
+                                        reply_markup=keyboards.CANCEL_KEYBOARD)
         return JOIN_NAME
 
-    data = load_data()
-    
-    participant_info = data["participants"].get(chat_id, {"user_id": user_id, "wishlist": None})
-    participant_info["name"] = name
-    participant_info["username"] = username
-    
-    data["participants"][chat_id] = participant_info
-    save_data(data)
+    games.for_chat(chat_id).store.set_name(chat_id, user_id, name, username)
 
     await update.message.reply_text(
         f"Отлично, {name}! Твоя информация обновлена. "
@@ -155,22 +268,23 @@ async def receive_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 async def wishlist(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the conversation for writing a wishlist."""
     chat_id = str(update.effective_chat.id)
-    data = load_data()
-    assignments_data = load_assignments()
-    game_started = bool(assignments_data["assignments"])
+    store = games.for_chat(chat_id).store
+    game_started = store.game_started
 
-    if chat_id not in data["participants"]:
-        await update.message.reply_text("Сначала тебе нужно присоединиться к игре с помощью кнопки \"Присоединиться к игре\".",
+    if not store.is_participant(chat_id):
+        await update.message.reply_text(f"Сначала тебе нужно присоединиться к игре с помощью кнопки "
+                                        f"\"{keyboards.label(keyboards.JOIN)}\".",
                                         reply_markup=get_main_keyboard(chat_id))
         return ConversationHandler.END
 
-    if game_started:
+    # Late joiners without a receiver yet may still write one before an admin adds them
+    if game_started and store.get_participant(chat_id)["user_id"] in store.assignments:
         await update.message.reply_text("Игра уже началась, поэтому изменения письма деду морозу больше невозможны.",
                                         reply_markup=get_main_keyboard(chat_id))
         return ConversationHandler.END
 
     await update.message.reply_text("Напиши свое письмо деду морозу для Тайного Санты. Будь креативным! (Это сообщение увидят)",
-                                    reply_markup=ReplyKeyboardMarkup([[KeyboardButton("Отмена")]], one_time_keyboard=True, resize_keyboard=True))
+                                    reply_markup=keyboards.CANCEL_KEYBOARD)
     return WISHLIST_TEXT
 
 async def receive_wishlist(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -180,167 +294,426 @@ async def receive_wishlist(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
     if not wishlist_text:
         await update.message.reply_text("Письмо деду морозу не может быть пустым. Пожалуйста, напиши что-нибудь.",
-                                        reply_markup=ReplyKeyboardMarkup([[KeyboardButton("Отмена")]], one_time_keyboard=True, resize_keyboard=True))
+                                        reply_markup=keyboards.CANCEL_KEYBOARD)
         return WISHLIST_TEXT
 
-    data = load_data()
-    if chat_id in data["participants"]:
-        data["participants"][chat_id]["wishlist"] = wishlist_text
-        save_data(data)
+    if games.for_chat(chat_id).store.set_wishlist(chat_id, wishlist_text):
         await update.message.reply_text("Твое письмо деду морозу сохранено! Жди начала игры.",
                                         reply_markup=get_main_keyboard(chat_id))
     else:
-        await update.message.reply_text("Кажется, ты не зарегистрирован. Используй кнопку \"Присоединиться к игре\", чтобы начать.",
+        await update.message.reply_text(f"Кажется, ты не зарегистрирован. Используй кнопку "
+                                        f"\"{keyboards.label(keyboards.JOIN)}\", чтобы начать.",
                                         reply_markup=get_main_keyboard(chat_id))
 
     return ConversationHandler.END
 
+def game_exclusions(game: Game) -> dict:
+    """Compiles the game's exclusion rules against its current participants."""
+    return exclusions.compile_rules(game.exclusion_rules, game.store)
+
 async def start_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Admin command to start the Secret Santa game and assign participants."""
-    if update.effective_user.id != ADMIN_USER_ID:
+    game = games.for_chat(str(update.effective_chat.id))
+    if not game.is_admin(update.effective_user.id):
         await update.message.reply_text("У тебя нет прав для выполнения этой команды.",
                                         reply_markup=get_main_keyboard(str(update.effective_chat.id)))
         return
 
-    data = load_data()
-    participants = list(data["participants"].values())
-
-    if len(participants) < 2:
+    store = game.store
+    if len(store.participants) < 2:
         await update.message.reply_text("Для начала игры необходимо минимум 2 участника.",
                                         reply_markup=get_main_keyboard(str(update.effective_chat.id)))
         return
 
-    # Convert excluded usernames to user IDs
-    excluded_pairs_user_ids = []
-    for u1_username, u2_username in EXCLUDED_PAIRS_USERNAMES:
-        u1_id = None
-        u2_id = None
-        for p in participants:
-            # Telegram usernames can be None if not set by the user
-            # We now primarily rely on 'name' for matching, as it's always provided during join.
-            if p["name"] == u1_username.strip("@"):
-                u1_id = p["user_id"]
-            if p["name"] == u2_username.strip("@"):
-                u2_id = p["user_id"]
-        if u1_id and u2_id:
-            excluded_pairs_user_ids.append((u1_id, u2_id))
-            excluded_pairs_user_ids.append((u2_id, u1_id)) # Add reverse for easier checking
-        else:
-            # Log a warning if one of the excluded users is not found among participants
-            logger.warning(
-                f"Could not find one or both participants for excluded pair: ({u1_username}, {u2_username}). "
-                f"Make sure they have joined and their name/username is correct."
-            )
+    # Everyone must have a wishlist; the store keeps the ones who don't, so they are named at once (as many as fit)
+    missing = store.missing_wishlists()
+    if missing:
+        names = notifications.name_list(sorted(store.participants[chat_id]["name"] for chat_id in missing))
+        await update.message.reply_text(
+            f"Еще не написали письмо деду морозу ({len(missing)}): {names}. Игра не может быть начата. "
+            "Полный список: /status",
+            reply_markup=get_main_keyboard(str(update.effective_chat.id))
+        )
+        return
 
-    # Check if all participants have a wishlist
-    for p in participants:
-        if not p["wishlist"]:
-            await update.message.reply_text(
-                f"Участник {p["name"]} еще не написал письмо деду морозу. Игра не может быть начата.",
-                reply_markup=get_main_keyboard(str(update.effective_chat.id))
-            )
-            return
+    try:
+        assignments = draw_assignments(
+            store.user_ids(),
+            game_exclusions(game),
+            single_cycle=ASSIGNMENT_MODE == "cycle"
+        )
+    except AssignmentError as e:
+        logger.warning(f"Could not draw assignments: {e}")
+        blocked_names = notifications.name_list(store.participant_by_user_id(user_id)["name"] for user_id in e.givers)
+        details = f" Слишком много исключений у участников: {blocked_names}." if blocked_names else ""
+        await update.message.reply_text(f"Не удалось найти подходящие пары для Тайного Санты.{details}",
+                                        reply_markup=get_main_keyboard(str(update.effective_chat.id)))
+        return
 
-    # Shuffle participants to create assignments
-    givers = participants[:]
-    receivers = participants[:]
-    random.shuffle(givers)
-    random.shuffle(receivers)
-
-    assignments = {}
-    attempt_count = 0
-    max_attempts = 100 # To prevent infinite loops in rare edge cases
-
-    while True:
-        current_assignments = {}
-        valid_assignment = True
-        temp_receivers = receivers[:]
-
-        for i, giver in enumerate(givers):
-            # Try to find a receiver that is not the giver themselves and not in excluded pairs
-            possible_receivers = [
-                r for r in temp_receivers 
-                if r["user_id"] != giver["user_id"] and 
-                (giver["user_id"], r["user_id"]) not in excluded_pairs_user_ids
-            ]
-
-            if not possible_receivers:
-                valid_assignment = False
-                break # Cannot make a valid assignment for this giver, restart the whole process
-
-            receiver = random.choice(possible_receivers)
-            current_assignments[giver["user_id"]] = receiver["user_id"]
-            temp_receivers.remove(receiver)
-        
-        if valid_assignment and not temp_receivers: # All givers assigned and all receivers taken
-            assignments = current_assignments
-            break
 
-        attempt_count += 1
-        if attempt_count > max_attempts:
-            await update.message.reply_text("Не удалось найти подходящие пары для Тайного Санты. Попробуй еще раз.",
-                                            reply_markup=get_main_keyboard(str(update.effective_chat.id)))
-            return
-        random.shuffle(receivers) # Reshuffle receivers if assignment failed
+    store.set_assignments(assignments)
+    notifications.render_all(store)
+    notifications.mark_all_pending(store)
+    # Kept in the metadata so jobs can skip started games without loading their stores
+    game.info["started"] = True
+    game.info["notifying"] = True
+    games.info_changed(game)
+
+    await update.message.reply_text("Игра Тайный Санта успешно начата! Отправляю участникам их подопечных...",
+                                    reply_markup=get_main_keyboard(str(update.effective_chat.id)))
+
+    # Notify each participant of their assigned person in the background
+    context.application.create_task(
+        run_notifications(context.application, update.effective_chat.id, game, list(assignments))
+    )
 
+async def resend_failed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin command to re-send assignment messages that were not delivered."""
+    game = games.for_chat(str(update.effective_chat.id))
+    if not game.is_admin(update.effective_user.id):
+        await update.message.reply_text("У тебя нет прав для выполнения этой команды.",
+                                        reply_markup=get_main_keyboard(str(update.effective_chat.id)))
+        return
 
-    assignments_data = {"assignments": assignments}
-    save_assignments(assignments_data)
+    givers = notifications.givers_with_status(game.store, notifications.PENDING, FAILED)
+    if not givers:
+        await update.message.reply_text("Все участники уже получили своих подопечных.",
+                                        reply_markup=get_main_keyboard(str(update.effective_chat.id)))
+        return
 
-    await update.message.reply_text("Игра Тайный Санта успешно начата! Участникам отправлены их подопечные.",
+    await update.message.reply_text(f"Повторно отправляю подопечных {len(givers)} участникам...",
                                     reply_markup=get_main_keyboard(str(update.effective_chat.id)))
+    context.application.create_task(run_notifications(context.application, update.effective_chat.id, game, givers))
+
+async def game_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin command that reports whether the game is ready to start and how delivery is going."""
+    chat_id = str(update.effective_chat.id)
+    game = games.for_chat(chat_id)
+    if not game.is_admin(update.effective_user.id):
+        await update.message.reply_text("У тебя нет прав для выполнения этой команды.",
+                                        reply_markup=get_main_keyboard(chat_id))
+        return
 
-    # Notify each participant of their assigned person
-    for giver_user_id, receiver_user_id in assignments.items():
-        giver_chat_id = next(chat_id for chat_id, p_data in data["participants"].items() if p_data["user_id"] == giver_user_id)
-        receiver_info = next(p_data for p_data in participants if p_data["user_id"] == receiver_user_id)
-        
+    store = game.store
+    missing = store.missing_wishlists()
+    lines = [f"Игра «{game.title}»",
+             f"Участников: {len(store.participants)}, написали письмо: {len(store.participants) - len(missing)}"]
+    if missing:
+        names = ", ".join(sorted(store.participants[missing_chat_id]["name"] for missing_chat_id in missing))
+        lines.append(f"Без письма ({len(missing)}): {names}")
+    unresolved = exclusions.unresolved(game.exclusion_rules, store)
+    lines.append(f"Исключений: {len(game.exclusion_rules)}")
+    if unresolved:
+        lines.append("Не найдены участники исключений: "
+                     + ", ".join(f"№{number} {reference}" for number, reference in unresolved))
+    if store.game_started:
+        stats = notifications.delivery_stats(store)
+        lines.append(f"Игра идет, пар: {len(store.assignments)}. Подопечные отправлены: {stats[SENT]}, "
+                     f"ожидают: {stats[notifications.PENDING]}, не доставлены: {stats[FAILED]}")
+    elif missing or len(store.participants) < 2:
+        lines.append("Игру пока нельзя начать.")
+    else:
+        lines.append("Все готово, можно начинать: /start_game")
+    for chunk in notifications.split_message("\n".join(lines)):
+        await update.message.reply_text(chunk, reply_markup=get_main_keyboard(chat_id))
+
+async def run_notifications(application: Application, admin_chat_id: int, game: Game, giver_user_ids: list,
+                            greeting: str = notifications.GREETING) -> None:
+    """Sends assignment messages to the given givers and reports the outcome to the admin."""
+    store = game.store
+    results = await notifications.notify_givers(
+        application.bot, store, broadcast_dispatcher, giver_user_ids,
+        lambda chat_id: keyboards.MAIN_KEYBOARDS[store.chat_state(chat_id)], greeting
+    )
+    if not notifications.givers_with_status(store, notifications.PENDING):
+        game.info["notifying"] = False
+        games.info_changed(game)
+    failed = [giver_user_id for giver_user_id, status in results.items() if status == FAILED]
+    report = f"Подопечные отправлены {len(results) - len(failed)} из {len(results)} участников."
+    if failed:
+        failed_names = [(store.participant_by_user_id(giver_user_id) or {}).get("name") or giver_user_id
+                        for giver_user_id in failed]
+        report += f"\nНе удалось отправить: {notifications.name_list(failed_names)}. Повторить: /resend_failed"
+    await application.bot.send_message(chat_id=admin_chat_id, text=report)
+
+async def resolve_participant(update: Update, store: StateStore, query: str):
+    """Finds the chat_id of the participant an admin named by user_id or name; replies and returns None if unclear."""
+    if query.isdigit():
+        chat_id = store.chat_id_for_user(query)
+        candidates = [chat_id] if chat_id is not None else []
+    else:
+        candidates = [store.chat_id_for_user(user_id) for user_id in store.user_ids_by_name(query.lstrip("@"))]
+    if len(candidates) != 1:
+        problem = "не найден" if not candidates else "найден не один, укажи user_id"
+        await update.message.reply_text(f"Участник «{query}» {problem}.",
+                                        reply_markup=get_main_keyboard(str(update.effective_chat.id)))
+        return None
+    return candidates[0]
+
+async def add_late(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin command that gives a participant who joined after the draw a place in the existing assignments."""
+    admin_chat_id = str(update.effective_chat.id)
+    game = games.for_chat(admin_chat_id)
+    if not game.is_admin(update.effective_user.id):
+        await update.message.reply_text("У тебя нет прав для выполнения этой команды.",
+                                        reply_markup=get_main_keyboard(admin_chat_id))
+        return
+    store = game.store
+    if not context.args or not store.game_started:
+        await update.message.reply_text("Использование после начала игры: /add_late <user_id или имя>",
+                                        reply_markup=get_main_keyboard(admin_chat_id))
+        return
+
+    chat_id = await resolve_participant(update, store, " ".join(context.args))
+    if chat_id is None:
+        return
+    participant_info = store.get_participant(chat_id)
+    if participant_info["user_id"] in store.assignments:
+        await update.message.reply_text(f"{participant_info['name']} уже участвует в жеребьевке.",
+                                        reply_markup=get_main_keyboard(admin_chat_id))
+        return
+    if not participant_info.has_wishlist:
+        await update.message.reply_text(f"Участник {participant_info['name']} еще не написал письмо деду морозу (/wishlist).",
+                                        reply_markup=get_main_keyboard(admin_chat_id))
+        return
+
+    try:
+        changes = add_participant(store.assignments, participant_info["user_id"], game_exclusions(game))
+    except AssignmentError as e:
+        logger.warning(f"Could not add {participant_info['user_id']} to the assignments: {e}")
+        await update.message.reply_text("Не удалось встроить участника в текущие пары из-за исключений.",
+                                        reply_markup=get_main_keyboard(admin_chat_id))
+        return
+    store.update_assignments(changes)
+    await announce_redraw(update, context, game, changes, f"{participant_info['name']} добавлен(а) в игру.")
+
+async def remove_dropout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin command that removes a participant and closes the gap they leave in the assignments."""
+    admin_chat_id = str(update.effective_chat.id)
+    game = games.for_chat(admin_chat_id)
+    if not game.is_admin(update.effective_user.id):
+        await update.message.reply_text("У тебя нет прав для выполнения этой команды.",
+                                        reply_markup=get_main_keyboard(admin_chat_id))
+        return
+    store = game.store
+    if not context.args:
+        await update.message.reply_text("Использование: /remove_participant <user_id или имя>",
+                                        reply_markup=get_main_keyboard(admin_chat_id))
+        return
+
+    chat_id = await resolve_participant(update, store, " ".join(context.args))
+    if chat_id is None:
+        return
+    participant_info = store.get_participant(chat_id)
+    user_id = participant_info["user_id"]
+    changes = {}
+    if user_id in store.assignments and len(store.assignments) <= 2:
+        # The one giver left would have nobody to give to, so the draw is undone and registration reopens
+        store.remove_participant(chat_id)
+        store.set_assignments({})
+        store.section(notifications.SECTION).clear()
+        store.section_changed(notifications.SECTION)
+        game.info["started"] = False
+        game.info["notifying"] = False
+        games.info_changed(game)
+        await update.message.reply_text(
+            f"{participant_info['name']} удален(а) из игры. В жеребьевке остался один участник, поэтому она "
+            "отменена. Начать игру заново: /start_game",
+            reply_markup=get_main_keyboard(admin_chat_id)
+        )
+        return
+    if user_id in store.assignments:
         try:
-            receiver_link = f" (@{receiver_info["username"]})" if receiver_info["username"] else ""
-            await context.application.bot.send_message(
-                chat_id=giver_chat_id,
-                text=f"Поздравляю! Твой подопечный в Тайном Санте - {receiver_info["name"]}{receiver_link}. "
-                     f"Вот его письмо деду морозу:\n\n{receiver_info["wishlist"]}",
-                reply_markup=get_main_keyboard(giver_chat_id)
-            )
-        except Exception as e:
-            logger.error(f"Could not send message to {giver_user_id}: {e}")
-            await update.message.reply_text(f"Не удалось отправить сообщение участнику {receiver_info["name"]}.",
-                                            reply_markup=get_main_keyboard(str(update.effective_chat.id)))
+            changes = remove_participant(store.assignments, user_id, game_exclusions(game))
+        except AssignmentError as e:
+            logger.warning(f"Could not remove {user_id} from the assignments: {e}")
+            await update.message.reply_text("Не удалось закрыть пару без этого участника из-за исключений.",
+                                            reply_markup=get_main_keyboard(admin_chat_id))
+            return
+        store.update_assignments(changes, removed=[user_id])
+        statuses = store.section(notifications.SECTION)
+        if statuses.pop(user_id, None) is not None:
+            store.section_changed(notifications.SECTION)
+    store.remove_participant(chat_id)
+    await announce_redraw(update, context, game, changes, f"{participant_info['name']} удален(а) из игры.")
+
+async def announce_redraw(update: Update, context: ContextTypes.DEFAULT_TYPE, game: Game, changes: dict,
+                          summary: str) -> None:
+    """Reports an incremental re-draw to the admin and sends new receivers to just the affected givers."""
+    store = game.store
+    if changes:
+        notifications.mark_pending(store, changes)
+        game.info["notifying"] = True
+        games.info_changed(game)
+        summary += f" Новых подопечных получат участников: {len(changes)}."
+    await update.message.reply_text(summary, reply_markup=get_main_keyboard(str(update.effective_chat.id)))
+    if changes:
+        context.application.create_task(run_notifications(
+            context.application, update.effective_chat.id, game, list(changes), notifications.REDRAW_GREETING
+        ))
+
+async def list_exclusions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin command that lists the game's exclusion rules with their numbers."""
+    chat_id = str(update.effective_chat.id)
+    game = games.for_chat(chat_id)
+    if not game.is_admin(update.effective_user.id):
+        await update.message.reply_text("У тебя нет прав для выполнения этой команды.",
+                                        reply_markup=get_main_keyboard(chat_id))
+        return
+    rules = game.exclusion_rules
+    lines = [f"{number}. {exclusions.describe(rule)}" for number, rule in enumerate(rules, start=1)]
+    text = "Исключения:\n" + "\n".join(lines) if lines else "Исключений нет."
+    text += ("\n\nДобавить: /exclude <кто> <кому>, /exclude_group <название> <участники...>, "
+             "/exclude_history [код игры]. Удалить: /remove_exclusion <номер>.\n"
+             "Участника можно указать как user_id, @username или имя (имена с пробелами разделяй через |). "
+             "Число — это user_id, а если участника с таким user_id нет, то имя.")
+    for chunk in notifications.split_message(text):
+        await update.message.reply_text(chunk, reply_markup=get_main_keyboard(chat_id))
+
+def rule_members(args: list) -> list:
+    """Splits command arguments into rule members: by "|" if present, otherwise by spaces."""
+    text = " ".join(args)
+    if "|" in text:
+        return [member.strip() for member in text.split("|") if member.strip()]
+    return args
+
+async def add_exclusion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin command that adds a pair, group or history exclusion rule."""
+    chat_id = str(update.effective_chat.id)
+    game = games.for_chat(chat_id)
+    if not game.is_admin(update.effective_user.id):
+        await update.message.reply_text("У тебя нет прав для выполнения этой команды.",
+                                        reply_markup=get_main_keyboard(chat_id))
+        return
+
+    command = update.message.text.split()[0].lstrip("/").split("@")[0]
+    args = context.args or []
+    if command == "exclude_group":
+        members = rule_members(args[1:]) if args else []
+        rule = exclusions.group_rule(args[0], members) if len(members) >= 2 else None
+    elif command == "exclude_history":
+        source = games.get(args[0]) if args else game
+        if source is None or not source.store.game_started:
+            await update.message.reply_text("В этой игре еще нет пар, которые можно запомнить.",
+                                            reply_markup=get_main_keyboard(chat_id))
+            return
+        rule = exclusions.history_rule(source.title, source.store.assignments)
+    else:
+        members = rule_members(args)
+        rule = exclusions.pair_rule(*members) if len(members) == 2 else None
+    if rule is None:
+        await update.message.reply_text("Использование: /exclude <кто> <кому> или /exclude_group <название> <участники...>",
+                                        reply_markup=get_main_keyboard(chat_id))
+        return
+
+    game.exclusion_rules.append(rule)
+    games.info_changed(game)
+    text = f"Добавлено исключение №{len(game.exclusion_rules)}: {exclusions.describe(rule)}"
+    unresolved = [reference for reference in rule.get("members", ()) if not exclusions.resolve(game.store, reference)]
+    if unresolved:
+        # Reported here and in /status rather than on every draw
+        text += f"\nПока не найдены среди участников: {', '.join(unresolved)}"
+    await update.message.reply_text(text, reply_markup=get_main_keyboard(chat_id))
+
+async def remove_exclusion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin command that deletes an exclusion rule by its number in /exclusions."""
+    chat_id = str(update.effective_chat.id)
+    game = games.for_chat(chat_id)
+    if not game.is_admin(update.effective_user.id):
+        await update.message.reply_text("У тебя нет прав для выполнения этой команды.",
+                                        reply_markup=get_main_keyboard(chat_id))
+        return
+    rules = game.exclusion_rules
+    if not context.args or not context.args[0].isdecimal() or not 1 <= int(context.args[0]) <= len(rules):
+        await update.message.reply_text("Использование: /remove_exclusion <номер из /exclusions>",
+                                        reply_markup=get_main_keyboard(chat_id))
+        return
+    rule = rules.pop(int(context.args[0]) - 1)
+    games.info_changed(game)
+    await update.message.reply_text(f"Исключение удалено: {exclusions.describe(rule)}",
+                                    reply_markup=get_main_keyboard(chat_id))
 
 async def my_santa(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Reveals the assigned person and their wishlist to the participant."""
     user_id = str(update.effective_user.id)
     chat_id = str(update.effective_chat.id)
+    store = games.for_chat(chat_id).store
 
-    assignments_data = load_assignments()
-    participants_data = load_data()
-
-    if user_id not in assignments_data["assignments"]:
+    if user_id not in store.assignments:
         await update.message.reply_text("Игра еще не началась, или у тебя нет подопечного. Дождись начала игры.",
                                         reply_markup=get_main_keyboard(chat_id))
         return
 
-    assigned_receiver_id = assignments_data["assignments"][user_id]
-    
-    receiver_info = None
-    for c_id, p_data in participants_data["participants"].items():
-        if p_data["user_id"] == assigned_receiver_id:
-            receiver_info = p_data
-            break
+    chunks = notifications.giftee_message(store, user_id)
 
-    if receiver_info:
-        receiver_link = f" (@{receiver_info["username"]})" if receiver_info["username"] else ""
-        await update.message.reply_text(
-            f"Твой подопечный в Тайном Санте - {receiver_info["name"]}{receiver_link}. "
-            f"Вот его письмо деду морозу:\n\n{receiver_info["wishlist"]}",
-            reply_markup=get_main_keyboard(chat_id)
+    if chunks:
+        await notifications.send_chunks(
+            lambda text, reply_markup: update.message.reply_text(text, reply_markup=reply_markup),
+            chunks, get_main_keyboard(chat_id)
         )
     else:
         await update.message.reply_text("Не удалось найти информацию о твоем подопечном. Возможно, произошла ошибка.",
                                         reply_markup=get_main_keyboard(chat_id))
 
+# Buttons that neither start nor continue a conversation: action -> callback. All of them share one handler, so
+# adding a button here adds no handler to check. Buttons that open a conversation are its entry points instead
+BUTTON_CALLBACKS = {
+    keyboards.MY_SANTA: my_santa,
+}
+
+async def button_pressed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Runs the callback of the pressed button from BUTTON_CALLBACKS."""
+    await BUTTON_CALLBACKS[keyboards.action_for(update.message.text)](update, context)
+
     
+async def relay_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Starts an anonymous message to the participant's Santa or giftee."""
+    chat_id = str(update.effective_chat.id)
+    store = games.for_chat(chat_id).store
+    text = update.message.text
+    if text.startswith("/write_santa") or keyboards.action_for(text) == keyboards.WRITE_SANTA:
+        direction = relay.SANTA
+    else:
+        direction = relay.GIFTEE
+
+    if relay.recipient_chat_id(store, str(update.effective_user.id), direction) is None:
+        whom = "Санты" if direction == relay.SANTA else "подопечного"
+        await update.message.reply_text(f"Игра еще не началась, или у тебя пока нет {whom}.",
+                                        reply_markup=get_main_keyboard(chat_id))
+        return ConversationHandler.END
+
+    context.user_data["relay_to"] = direction
+    whom = "Санте" if direction == relay.SANTA else "подопечному"
+    await update.message.reply_text(
+        f"Напиши сообщение {whom} — можно текст, фото, видео или голосовое. Я передам его анонимно.",
+        reply_markup=keyboards.CANCEL_KEYBOARD
+    )
+    return RELAY_MESSAGE
+
+async def relay_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Queues the message for anonymous delivery to the other side of the participant's pair."""
+    chat_id = str(update.effective_chat.id)
+    store = games.for_chat(chat_id).store
+    direction = context.user_data.pop("relay_to", relay.GIFTEE)
+    # Looked up again: the pairs may have been re-drawn while the participant was typing
+    recipient = relay.recipient_chat_id(store, str(update.effective_user.id), direction)
+    if recipient is None:
+        await update.message.reply_text("Не удалось найти получателя. Возможно, жеребьевка изменилась.",
+                                        reply_markup=get_main_keyboard(chat_id))
+        return ConversationHandler.END
+
+    bot = context.bot
+
+    async def on_failed():
+        await bot.send_message(chat_id=chat_id, text="Не удалось доставить твое сообщение, попробуй позже.")
+
+    if relay_outbox.put(recipient, relay.relayed_sender(bot, update.message, direction), on_failed):
+        reply = "Сообщение отправлено анонимно ✉️"
+    else:
+        reply = "Сейчас слишком много сообщений, попробуй чуть позже."
+    await update.message.reply_text(reply, reply_markup=get_main_keyboard(chat_id))
+    return ConversationHandler.END
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels and ends the conversation."""
     chat_id = str(update.effective_chat.id)
@@ -349,33 +722,28 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Admin command to start a broadcast message to all participants."""
-    if update.effective_user.id != ADMIN_USER_ID:
+    if not games.for_chat(str(update.effective_chat.id)).is_admin(update.effective_user.id):
         await update.message.reply_text("У тебя нет прав для выполнения этой команды.")
         return ConversationHandler.END
 
-    keyboard = [
-        [KeyboardButton("Текст"), KeyboardButton("Фото"), KeyboardButton("Видео")]
-    ]
     await update.message.reply_text(
         "Что ты хочешь разослать всем участникам?",
-        reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
+        reply_markup=keyboards.BROADCAST_TYPE_KEYBOARD
     )
     return BROADCAST_TYPE
 
 async def receive_broadcast_type(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Receives the type of broadcast message."""
-    broadcast_type = update.message.text
-    if broadcast_type not in ["Текст", "Фото", "Видео"]:
+    broadcast_type = keyboards.action_for(update.message.text)
+    if broadcast_type not in BROADCAST_CONTENT_NAMES:
         await update.message.reply_text("Пожалуйста, выбери тип из предложенных кнопок.",
-                                        reply_markup=ReplyKeyboardMarkup(
-                                            [[KeyboardButton("Текст"), KeyboardButton("Фото"), KeyboardButton("Видео")]],
-                                            one_time_keyboard=True, resize_keyboard=True))
+                                        reply_markup=keyboards.BROADCAST_TYPE_KEYBOARD)
         return BROADCAST_TYPE
 
     context.user_data["broadcast_type"] = broadcast_type
     await update.message.reply_text(
-        f"Отправь {'текст' if broadcast_type == 'Текст' else 'фото' if broadcast_type == 'Фото' else 'видео'} для рассылки.",
-        reply_markup=ReplyKeyboardMarkup([[KeyboardButton("Отмена")]], one_time_keyboard=True, resize_keyboard=True)
+        f"Отправь {BROADCAST_CONTENT_NAMES[broadcast_type]} для рассылки.",
+        reply_markup=keyboards.CANCEL_KEYBOARD
     )
     return BROADCAST_CONTENT
 
@@ -385,14 +753,14 @@ async def receive_broadcast_content(update: Update, context: ContextTypes.DEFAUL
     content_to_send = None
     confirmation_message = ""
 
-    if broadcast_type == "Текст":
+    if broadcast_type == keyboards.BROADCAST_TEXT:
         if not update.message.text:
             await update.message.reply_text("Текст не может быть пустым. Пожалуйста, отправь текст.")
             return BROADCAST_CONTENT
         content_to_send = update.message.text
         confirmation_message = f"Ты собираешься разослать следующий текст:\n\n{content_to_send}\n\nПодтверждаешь отправку?"
 
-    elif broadcast_type == "Фото":
+    elif broadcast_type == keyboards.BROADCAST_PHOTO:
         if not update.message.photo:
             await update.message.reply_text("Пожалуйста, отправь фото.")
             return BROADCAST_CONTENT
@@ -400,7 +768,7 @@ async def receive_broadcast_content(update: Update, context: ContextTypes.DEFAUL
         confirmation_message = "Ты собираешься разослать это фото.\n\nПодтверждаешь отправку?"
         context.user_data["broadcast_file_id"] = content_to_send
 
-    elif broadcast_type == "Видео":
+    elif broadcast_type == keyboards.BROADCAST_VIDEO:
         if not update.message.video:
             await update.message.reply_text("Пожалуйста, отправь видео.")
             return BROADCAST_CONTENT
@@ -410,40 +778,37 @@ async def receive_broadcast_content(update: Update, context: ContextTypes.DEFAUL
 
     if content_to_send:
         context.user_data["broadcast_content"] = content_to_send
-        keyboard = [[KeyboardButton("Да, отправить"), KeyboardButton("Нет, отмена")]]
-        await update.message.reply_text(confirmation_message,
-                                        reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True))
-        if broadcast_type == "Фото":
+        await update.message.reply_text(confirmation_message, reply_markup=keyboards.BROADCAST_CONFIRM_KEYBOARD)
+        if broadcast_type == keyboards.BROADCAST_PHOTO:
             await update.message.reply_photo(photo=content_to_send)
-        elif broadcast_type == "Видео":
+        elif broadcast_type == keyboards.BROADCAST_VIDEO:
             await update.message.reply_video(video=content_to_send)
         return BROADCAST_CONFIRM
     return ConversationHandler.END
 
 async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Confirms and sends the broadcast message to all participants."""
-    if update.message.text == "Да, отправить":
+    if keyboards.action_for(update.message.text) == keyboards.CONFIRM:
         broadcast_type = context.user_data["broadcast_type"]
         content_to_send = context.user_data["broadcast_content"]
-        
-        data = load_data()
-        participants = data.get("participants", {})
-
-        sent_count = 0
-        for chat_id, p_data in participants.items():
-            try:
-                if broadcast_type == "Текст":
-                    await context.application.bot.send_message(chat_id=chat_id, text=content_to_send)
-                elif broadcast_type == "Фото":
-                    await context.application.bot.send_photo(chat_id=chat_id, photo=context.user_data["broadcast_file_id"])
-                elif broadcast_type == "Видео":
-                    await context.application.bot.send_video(chat_id=chat_id, video=context.user_data["broadcast_file_id"])
-                sent_count += 1
-            except Exception as e:
-                logger.error(f"Could not send broadcast to {p_data.get("name", chat_id)} ({chat_id}): {e}")
-        
-        await update.message.reply_text(f"Рассылка завершена. Отправлено {sent_count} сообщений.",
+        bot = context.application.bot
+        game = games.for_chat(str(update.effective_chat.id))
+
+        async def send(chat_id):
+            if broadcast_type == keyboards.BROADCAST_TEXT:
+                await bot.send_message(chat_id=chat_id, text=content_to_send)
+            elif broadcast_type == keyboards.BROADCAST_PHOTO:
+                await bot.send_photo(chat_id=chat_id, photo=content_to_send)
+            elif broadcast_type == keyboards.BROADCAST_VIDEO:
+                await bot.send_video(chat_id=chat_id, video=content_to_send)
+
+        await update.message.reply_text(f"Рассылка началась: {len(game.store.participants)} получателей. "
+                                        "Я пришлю отчет, когда она закончится.",
                                         reply_markup=get_main_keyboard(str(update.effective_chat.id)))
+        # Run in the background so the admin's chat is not blocked while sending
+        context.application.create_task(
+            run_broadcast(context.application, update.effective_chat.id, game, list(game.store.participants), send)
+        )
     else:
         await update.message.reply_text("Рассылка отменена.",
                                         reply_markup=get_main_keyboard(str(update.effective_chat.id)))
@@ -454,34 +819,269 @@ async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE)
     context.user_data.pop("broadcast_file_id", None)
     return ConversationHandler.END
 
+async def run_broadcast(application: Application, admin_chat_id: int, game: Game, chat_ids: list, send) -> None:
+    """Delivers a broadcast through the shared dispatcher and reports progress to the admin."""
+    progress_message = await application.bot.send_message(chat_id=admin_chat_id, text=f"Отправлено 0 из {len(chat_ids)}...")
+    report_every = max(1, len(chat_ids) // 10)
+
+    async def progress(done, total):
+        if done % report_every == 0 and done < total:
+            try:
+                await progress_message.edit_text(f"Отправлено {done} из {total}...")
+            except Exception as e:
+                logger.warning(f"Could not update broadcast progress: {e}")
+
+    results = await broadcast_dispatcher.run(chat_ids, send, progress)
+    failed = [chat_id for chat_id, status in results.items() if status == FAILED]
+    report = f"Рассылка завершена. Отправлено {len(results) - len(failed)} из {len(results)} сообщений."
+    if failed:
+        failed_names = [game.store.participants.get(chat_id, {}).get("name") or chat_id for chat_id in failed]
+        report += f"\nНе доставлено ({len(failed)}): {notifications.name_list(failed_names)}"
+    await application.bot.send_message(chat_id=admin_chat_id, text=report)
+
+async def remind_stragglers(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job that reminds participants who have not finished joining a game that has not started yet."""
+    if reminders.in_quiet_hours(datetime.datetime.now(REMINDER_TIMEZONE).hour, REMINDER_QUIET_HOURS):
+        return
+    # Chats the join conversation is still asking for a name, by the game they are joining; looked up in the
+    # memberships alone, so no game's store is loaded just to sort them
+    chats_without_name = {}
+    for key, state in games.default_store.section(CONVERSATIONS_SECTION).get("join", {}).items():
+        if state == JOIN_NAME:
+            chat_id, user_id = (str(part) for part in json.loads(key))
+            chats_without_name.setdefault(games.code_for_chat(chat_id), []).append((chat_id, user_id))
+
+    now = time.time()
+    remaining = REMINDER_BATCH_SIZE
+    for code in games.all_codes():
+        if games.info(code).get("started"):
+            continue
+        game = games.get(code)
+        store = game.store
+        if store.game_started:
+            # Started without the flag, e.g. before it was kept; record it so the game is not loaded again
+            game.info["started"] = True
+            games.info_changed(game)
+            continue
+        pending = reminders.stragglers(store, chats_without_name.get(code, ()))
+        batch = reminders.due(store, pending, now, REMINDER_INTERVAL_HOURS * 3600, remaining)
+        if not batch:
+            continue
+        await reminders.send_reminders(
+            context.bot, store, broadcast_dispatcher, batch, now,
+            lambda chat_id: keyboards.MAIN_KEYBOARDS[store.chat_state(chat_id)]
+        )
+        remaining -= len(batch)
+        if remaining <= 0:
+            break
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and send a telegram message to notify the developer."""
     logger.error("Exception while handling an update:", exc_info=context.error)
     # You might want to send a message to yourself here to be notified of errors
 
-def load_data():
-    if os.path.exists(PARTICIPANTS_FILE):
-        with open(PARTICIPANTS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {"participants": {}}
+async def new_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Creates a separate game with the caller as its admin and replies with an invite link."""
+    chat_id = str(update.effective_chat.id)
+    user_id = update.effective_user.id
+    if user_id != ADMIN_USER_ID:
+        if GAME_CREATORS != "anyone":
+            await update.message.reply_text("У тебя нет прав для выполнения этой команды.",
+                                            reply_markup=get_main_keyboard(chat_id))
+            return
+        if games.created_by(user_id) >= MAX_GAMES_PER_USER:
+            await update.message.reply_text(f"Можно создать не больше {MAX_GAMES_PER_USER} игр.",
+                                            reply_markup=get_main_keyboard(chat_id))
+            return
+    current = games.for_chat(chat_id)
+    if current.holds(chat_id):
+        await reply_game_held(update, current)
+        return
+    title = " ".join(context.args) if context.args else "Тайный Санта"
+    game = games.create(title, user_id)
+    games.join(chat_id, game.code)
+    await update.message.reply_text(
+        f"Игра «{game.title}» создана, ты ее администратор.\n"
+        f"Ссылка для участников: {invite_link(context, game)}\n"
+        f"Или код для команды /join: {game.code}",
+        reply_markup=get_main_keyboard(chat_id)
+    )
+
+async def invite(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin command that shows the invite link of the current game."""
+    chat_id = str(update.effective_chat.id)
+    game = games.for_chat(chat_id)
+    if not game.is_admin(update.effective_user.id):
+        await update.message.reply_text("У тебя нет прав для выполнения этой команды.",
+                                        reply_markup=get_main_keyboard(chat_id))
+        return
+    await update.message.reply_text(f"Ссылка-приглашение в игру «{game.title}»: {invite_link(context, game)}",
+                                    reply_markup=get_main_keyboard(chat_id))
 
-def save_data(data):
-    with open(PARTICIPANTS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+def invite_link(context: ContextTypes.DEFAULT_TYPE, game: Game) -> str:
+    return f"https://t.me/{context.bot.username}?start={game.code}"
+
+async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin command that sends the game's participants (and assignments, if drawn) as CSV or JSONL files."""
+    chat_id = str(update.effective_chat.id)
+    game = games.for_chat(chat_id)
+    if not game.is_admin(update.effective_user.id):
+        await update.message.reply_text("У тебя нет прав для выполнения этой команды.",
+                                        reply_markup=get_main_keyboard(chat_id))
+        return
 
-def load_assignments():
-    if os.path.exists(ASSIGNMENTS_FILE):
-        with open(ASSIGNMENTS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {"assignments": {}}
+    fmt = context.args[0].lower() if context.args else bulk_io.CSV
+    if fmt not in bulk_io.FORMATS:
+        await update.message.reply_text("Использование: /export [csv|jsonl]", reply_markup=get_main_keyboard(chat_id))
+        return
 
-def save_assignments(assignments_data):
-    with open(ASSIGNMENTS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(assignments_data, f, ensure_ascii=False, indent=4)
+    exports = [("participants", bulk_io.export_participants, "Участники")]
+    if game.store.game_started:
+        exports.append(("assignments", bulk_io.export_assignments, "Пары"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, export, caption in exports:
+            path = os.path.join(tmp, f"{name}.{fmt}")
+            count = await export(game.store, path, fmt)
+            with open(path, 'rb') as f:
+                await update.message.reply_document(document=f, filename=f"{name}.{fmt}",
+                                                    caption=f"{caption}: {count}")
+
+async def import_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin handler for a CSV/JSONL document sent with the caption /import."""
+    chat_id = str(update.effective_chat.id)
+    game = games.for_chat(chat_id)
+    if not game.is_admin(update.effective_user.id):
+        await update.message.reply_text("У тебя нет прав для выполнения этой команды.",
+                                        reply_markup=get_main_keyboard(chat_id))
+        return
+
+    document = update.message.document
+    fmt = bulk_io.format_for(document.file_name) if document else None
+    if fmt is None:
+        await update.message.reply_text(
+            "Отправь файл .csv или .jsonl с подписью /import.\n"
+            "Участники: колонки user_id, name и по желанию chat_id, username, wishlist.\n"
+            "Пары: колонки giver_user_id и receiver_user_id.",
+            reply_markup=get_main_keyboard(chat_id)
+        )
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, f"import.{fmt}")
+        telegram_file = await context.bot.get_file(document.file_id)
+        await telegram_file.download_to_drive(path)
+        try:
+            result = await bulk_io.import_file(game.store, path, fmt, game_exclusions(game))
+        except bulk_io.ImportRejected as e:
+            await update.message.reply_text(str(e), reply_markup=get_main_keyboard(chat_id))
+            return
+
+    if result.kind == "participants":
+        summary = f"Импорт участников: добавлено {result.added}, обновлено {result.updated}"
+    elif result.errors:
+        summary = "Пары не импортированы, в файле есть ошибки"
+    else:
+        summary = f"Импортировано пар: {result.added}"
+    summary += f", отклонено записей: {len(result.errors)}." if result.errors else "."
+    if result.kind == "assignments" and not result.errors:
+        # The imported pairs replace any earlier draw; givers only hear about them once the admin sends them
+        game.info["started"] = True
+        game.info["notifying"] = False
+        games.info_changed(game)
+        summary += "\nУчастники еще не знают своих подопечных, отправить им: /resend_failed"
+    await update.message.reply_text(summary, reply_markup=get_main_keyboard(chat_id))
+    if result.errors:
+        await update.message.reply_document(document=result.error_report().encode("utf-8"),
+                                            filename="import_errors.txt")
+
+async def metrics_endpoint(request):
+    return Response(HTTPStatus.OK, metrics.REGISTRY.render().encode(), "text/plain; version=0.0.4; charset=utf-8")
+
+async def post_init(application: Application) -> None:
+    """Starts the metrics endpoint and resumes assignment notifications interrupted by a restart."""
+    if metrics_server is not None:
+        metrics_server.add_route("GET", "/metrics", metrics_endpoint)
+        await metrics_server.start()
+    relay_outbox.start()
+    # Only games whose metadata says a delivery was interrupted are loaded here; the others wait until touched
+    for code in games.all_codes():
+        if not games.info(code).get("notifying"):
+            continue
+        game = games.get(code)
+        pending = notifications.givers_with_status(game.store, notifications.PENDING)
+        if pending:
+            logger.info(f"Resuming {len(pending)} pending assignment notifications for game {code}")
+            admin_chat_id = next(iter(game.admins), ADMIN_USER_ID)
+            application.create_task(run_notifications(application, admin_chat_id, game, pending))
+
+async def post_shutdown(application: Application) -> None:
+    """Writes pending participant/assignment changes before the process exits."""
+    await relay_outbox.stop()
+    await games.flush()
+    if metrics_server is not None:
+        await metrics_server.stop()
+
+async def run_webhook(application: Application) -> None:
+    """Serves Telegram updates over the embedded HTTP server until SIGINT/SIGTERM."""
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL (or RENDER_EXTERNAL_URL) must be set in webhook mode")
+
+    async def telegram_webhook(request):
+        secret = request.headers.get("x-telegram-bot-api-secret-token", "")
+        # Compared as bytes: compare_digest rejects str with non-ASCII characters, which a client may send
+        if not hmac.compare_digest(secret.encode("latin-1"), WEBHOOK_SECRET.encode()):
+            return Response(HTTPStatus.FORBIDDEN, b"forbidden")
+        try:
+            update = Update.de_json(json.loads(request.body), application.bot)
+        except ValueError:
+            return Response(HTTPStatus.BAD_REQUEST, b"bad update")
+        # Queue and answer right away; Telegram waits for the response before sending more
+        await application.update_queue.put(update)
+        return Response(HTTPStatus.OK, b"ok")
+
+    async def health_check(request):
+        return Response(HTTPStatus.OK, b"ok")
+
+    server = HttpServer("0.0.0.0", PORT)
+    server.add_route("POST", WEBHOOK_PATH, telegram_webhook)
+    server.add_route("GET", "/healthz", health_check)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    # run_polling calls post_init/post_shutdown itself; here it is up to us
+    async with application:
+        await application.post_init(application)
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+        await application.start()
+        await server.start()
+        logger.info("Webhook mode is running")
+        await stop_event.wait()
+        await server.stop()
+        await application.stop()
+    await application.post_shutdown(application)
 
 def main() -> None:
     """Start the bot."""
-    application = Application.builder().token(TOKEN).build()
+    games.load()
+
+    application = (
+        Application.builder().token(TOKEN)
+        # Same pool sizes as the builder's defaults, but every Bot API call is counted and timed
+        .request(metrics.InstrumentedRequest(connection_pool_size=256))
+        .get_updates_request(metrics.InstrumentedRequest(connection_pool_size=1))
+        # Chats run in parallel, each chat's updates still in order, so conversations stay consistent
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        # Conversation states and user_data survive restarts, written behind with the rest of the state
+        .persistence(StorePersistence(games.default_store))
+        .post_init(post_init).post_shutdown(post_shutdown).build()
+    )
 
     # On different commands - answer in Telegram
     application.add_handler(CommandHandler("help", help_command))
@@ -491,12 +1091,14 @@ def main() -> None:
         entry_points=[
             CommandHandler("start", start),
             CommandHandler("join", join),
-            MessageHandler(filters.Regex("^🎅 Присоединиться к игре 🎄$|^✏️ Изменить имя$"), join)
+            MessageHandler(keyboards.Button(keyboards.JOIN, keyboards.RENAME), join)
         ],
         states={
-            JOIN_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_name)],
+            JOIN_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~keyboards.Button(keyboards.CANCEL), receive_name)],
         },
-        fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+        fallbacks=[CommandHandler("cancel", cancel), MessageHandler(keyboards.Button(keyboards.CANCEL), cancel)],
+        name="join",
+        persistent=True,
     )
     application.add_handler(join_conv_handler)
 
@@ -504,36 +1106,85 @@ def main() -> None:
     wishlist_conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler("wishlist", wishlist),
-            MessageHandler(filters.Regex("^📝 Написать письмо деду морозу 🎁$"), wishlist)
+            MessageHandler(keyboards.Button(keyboards.WISHLIST), wishlist)
         ],
         states={
-            WISHLIST_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_wishlist)],
+            WISHLIST_TEXT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND & ~keyboards.Button(keyboards.CANCEL), receive_wishlist)
+            ],
         },
-        fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+        fallbacks=[CommandHandler("cancel", cancel), MessageHandler(keyboards.Button(keyboards.CANCEL), cancel)],
+        name="wishlist",
+        persistent=True,
     )
     application.add_handler(wishlist_conv_handler)
 
     application.add_handler(CommandHandler("start_game", start_game))
+    application.add_handler(CommandHandler("resend_failed", resend_failed))
+    application.add_handler(CommandHandler("status", game_status))
+    application.add_handler(CommandHandler("new_game", new_game))
+    application.add_handler(CommandHandler("invite", invite))
+    application.add_handler(CommandHandler("add_late", add_late))
+    application.add_handler(CommandHandler("exclusions", list_exclusions))
+    application.add_handler(CommandHandler(["exclude", "exclude_group", "exclude_history"], add_exclusion))
+    application.add_handler(CommandHandler("remove_exclusion", remove_exclusion))
+    application.add_handler(CommandHandler("remove_participant", remove_dropout))
+    application.add_handler(CommandHandler("export", export_data))
+    application.add_handler(CommandHandler("import", import_data))
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import\b"), import_data))
     application.add_handler(CommandHandler("my_santa", my_santa))
-    application.add_handler(MessageHandler(filters.Regex("^🎁 Мой Санта 🎅$"), my_santa))
+    application.add_handler(MessageHandler(keyboards.Button(*BUTTON_CALLBACKS), button_pressed))
+
+    # Conversation handler for anonymous messages between Santas and giftees
+    relay_conv_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler(["write_santa", "write_giftee"], relay_start),
+            MessageHandler(keyboards.Button(keyboards.WRITE_SANTA, keyboards.WRITE_GIFTEE), relay_start)
+        ],
+        states={
+            RELAY_MESSAGE: [MessageHandler(~filters.COMMAND & ~keyboards.Button(keyboards.CANCEL), relay_message)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel), MessageHandler(keyboards.Button(keyboards.CANCEL), cancel)],
+        name="relay",
+        persistent=True,
+    )
+    application.add_handler(relay_conv_handler)
 
     # Conversation handler for broadcast functionality
     broadcast_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("broadcast", broadcast)],
         states={
-            BROADCAST_TYPE: [MessageHandler(filters.Regex("^(Текст|Фото|Видео)$"), receive_broadcast_type)],
-            BROADCAST_CONTENT: [MessageHandler(filters.TEXT | filters.PHOTO | filters.VIDEO & ~filters.COMMAND, receive_broadcast_content)],
-            BROADCAST_CONFIRM: [MessageHandler(filters.Regex("^(Да, отправить|Нет, отмена)$"), confirm_broadcast)],
+            BROADCAST_TYPE: [MessageHandler(keyboards.Button(*BROADCAST_CONTENT_NAMES), receive_broadcast_type)],
+            BROADCAST_CONTENT: [MessageHandler((filters.TEXT | filters.PHOTO | filters.VIDEO) & ~filters.COMMAND
+                                               & ~keyboards.Button(keyboards.CANCEL), receive_broadcast_content)],
+            BROADCAST_CONFIRM: [MessageHandler(keyboards.Button(keyboards.CONFIRM, keyboards.DECLINE), confirm_broadcast)],
         },
-        fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+        fallbacks=[CommandHandler("cancel", cancel), MessageHandler(keyboards.Button(keyboards.CANCEL), cancel)],
+        name="broadcast",
+        persistent=True,
     )
     application.add_handler(broadcast_conv_handler)
 
     # Log all errors
     application.add_error_handler(error_handler)
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if REMINDER_INTERVAL_HOURS > 0:
+        if application.job_queue is None:
+            logger.warning("Reminders need python-telegram-bot[job-queue], they are disabled")
+        else:
+            application.job_queue.run_repeating(remind_stragglers, interval=REMINDER_CHECK_MINUTES * 60,
+                                                first=REMINDER_CHECK_MINUTES * 60, name="reminders")
+
+    # Time every handler registered above and log (optionally profile) slow updates
+    metrics.instrument_application(
+        application, metrics.SlowUpdateProfiler(SLOW_UPDATE_SECONDS, PROFILE_SAMPLE_RATE)
+    )
+
+    if RUN_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        # Run the bot until the user presses Ctrl-C
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     main()
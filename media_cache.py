@@ -0,0 +1,99 @@
+import asyncio
+import hashlib
+import logging
+import os
+
+from telegram import InputFile
+from telegram.error import BadRequest
+
+from storage import StateStore
+
+logger = logging.getLogger(__name__)
+
+# Store section mapping a content key to the Telegram file_id it was uploaded as
+SECTION = "media_cache"
+
+
+class MediaCache:
+    """Remembers the file_ids of media the bot has already sent, so each file is uploaded once.
+
+    Local files are keyed by the SHA-256 of their content. A changed file gets
+    a new key and is uploaded again; a file_id Telegram rejects is forgotten
+    and re-uploaded. Broadcast media need no entry here: they arrive from
+    Telegram with a file_id and are always sent by it.
+    """
+
+    def __init__(self, store: StateStore):
+        self.store = store
+        # (path, mtime, size) -> content key, so a file is only hashed again after it changes
+        self._local_keys = {}
+        self._upload_locks = {}
+
+    def get(self, key: str):
+        return self.store.section(SECTION).get(key)
+
+    def remember(self, key: str, file_id: str) -> None:
+        entries = self.store.section(SECTION)
+        if entries.get(key) != file_id:
+            entries[key] = file_id
+            self.store.section_changed(SECTION)
+
+    def forget(self, key: str) -> None:
+        if self.store.section(SECTION).pop(key, None) is not None:
+            self.store.section_changed(SECTION)
+
+    async def local_file_key(self, path: str) -> str:
+        stat = os.stat(path)
+        fingerprint = (path, stat.st_mtime_ns, stat.st_size)
+        key = self._local_keys.get(fingerprint)
+        if key is None:
+            digest = await asyncio.to_thread(_sha256, path)
+            key = self._local_keys[fingerprint] = f"sha256:{digest}"
+        return key
+
+    async def send_local_file(self, path: str, send):
+        """Sends a local file through `send(media)`, reusing the cached file_id when possible.
+
+        `send` is called with a file_id string or an InputFile and must return
+        the resulting Message. Raises FileNotFoundError if the file is missing.
+        """
+        key = await self.local_file_key(path)
+        file_id = self.get(key)
+        if file_id is None:
+            # Chats handled concurrently wait for the first upload instead of each uploading the file
+            async with self._upload_locks.setdefault(key, asyncio.Lock()):
+                file_id = self.get(key)
+                if file_id is None:
+                    return await self._upload(path, key, send)
+        try:
+            return await send(file_id)
+        except BadRequest as e:
+            logger.warning(f"Cached file_id for {path} was rejected, uploading again: {e}")
+            self.forget(key)
+        return await self._upload(path, key, send)
+
+    async def _upload(self, path: str, key: str, send):
+        with open(path, 'rb') as f:
+            message = await send(InputFile(f))
+        file_id = _message_file_id(message)
+        if file_id is not None:
+            self.remember(key, file_id)
+        return message
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _message_file_id(message):
+    # Telegram may deliver an uploaded mp4 as a video, an animation or a document
+    for media in (message.video, message.animation, message.document):
+        if media is not None:
+            return media.file_id
+    if message.photo:
+        return message.photo[-1].file_id
+    return None
@@ -0,0 +1,214 @@
+import cProfile
+import io
+import logging
+import pstats
+import random
+import time
+from contextlib import contextmanager
+
+from telegram.ext import ConversationHandler
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Seconds; spans everything from an in-memory handler to a slow Bot API round trip
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Registry:
+    """All metrics of the process, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        registry.register(self)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS,
+                 registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self._values = {}
+        registry.register(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        counts = self._values.get(key)
+        if counts is None:
+            counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[len(self.buckets)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for key, counts in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ("le",), key + (str(bound),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {counts[-1]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+HANDLER_SECONDS = Histogram("santa_handler_duration_seconds", "Time spent handling one update, by handler callback.",
+                            ("handler",))
+HANDLER_ERRORS = Counter("santa_handler_errors_total", "Updates whose handler raised, by handler callback.",
+                         ("handler",))
+STORAGE_SECONDS = Histogram("santa_storage_duration_seconds", "Time spent in storage operations.", ("operation",))
+STORAGE_ERRORS = Counter("santa_storage_errors_total", "Failed storage writes.", ("operation",))
+BOT_API_SECONDS = Histogram("santa_bot_api_duration_seconds", "Bot API round trip time, by method.", ("method",))
+BOT_API_CALLS = Counter("santa_bot_api_calls_total", "Bot API calls, by method and result (ok or the error type).",
+                        ("method", "result"))
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records every Bot API call by method and outcome."""
+
+    async def post(self, url: str, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        result = "ok"
+        started = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception as e:
+            result = type(e).__name__
+            raise
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - started, method=method)
+            BOT_API_CALLS.inc(method=method, result=result)
+
+
+class SlowUpdateProfiler:
+    """Logs updates slower than `threshold` seconds, with a cProfile report for a sample of them.
+
+    `sample_rate` of all updates run under the profiler (only one at a time,
+    cProfile cannot be nested). Because handlers await, the report also
+    covers whatever else ran on the event loop meanwhile.
+    """
+
+    def __init__(self, threshold: float, sample_rate: float = 0.0, top: int = 25):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.top = top
+        self._profiling = False
+
+    async def run(self, name: str, callback, update, context):
+        profile = None
+        if not self._profiling and self.sample_rate > 0 and random.random() < self.sample_rate:
+            profile = cProfile.Profile()
+            self._profiling = True
+            profile.enable()
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            if profile is not None:
+                profile.disable()
+                self._profiling = False
+            if elapsed >= self.threshold:
+                self._report(name, elapsed, profile)
+
+    def _report(self, name: str, elapsed: float, profile) -> None:
+        if profile is None:
+            logger.warning(f"Slow update in {name}: {elapsed:.3f}s")
+            return
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(self.top)
+        logger.warning(f"Slow update in {name}: {elapsed:.3f}s, profile:\n{stream.getvalue()}")
+
+
+def instrument_application(application, profiler: SlowUpdateProfiler = None) -> None:
+    """Wraps the callback of every registered handler, including those inside conversations."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler, profiler)
+
+
+def _instrument_handler(handler, profiler) -> None:
+    if isinstance(handler, ConversationHandler):
+        children = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            children.extend(state_handlers)
+        for child in children:
+            _instrument_handler(child, profiler)
+        return
+    handler.callback = _timed_callback(handler.callback, profiler)
+
+
+def _timed_callback(callback, profiler):
+    name = callback.__name__
+
+    async def timed(update, context):
+        started = time.perf_counter()
+        try:
+            if profiler is not None:
+                return await profiler.run(name, callback, update, context)
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+    timed.__name__ = name
+    return timed
@@ -0,0 +1,44 @@
+import glob
+import os
+import sys
+
+from games import GAMES_DIR, game_file
+from persistence import JsonBackend
+from sqlite_storage import SqliteBackend
+
+PARTICIPANTS_FILE = "participants.json"
+ASSIGNMENTS_FILE = "assignments.json"
+SQLITE_DB_FILE = os.environ.get("SQLITE_DB_FILE", "santa.db")
+
+def section_names(directory):
+    """Returns the auxiliary sections (notifications, games, conversations...) JsonBackend keeps in `directory`."""
+    names = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        file_name = os.path.basename(path)
+        if file_name not in (PARTICIPANTS_FILE, ASSIGNMENTS_FILE):
+            names.append(file_name[:-len(".json")])
+    return names
+
+def migrate_game(directory, db_file):
+    source = JsonBackend(os.path.join(directory, PARTICIPANTS_FILE), os.path.join(directory, ASSIGNMENTS_FILE))
+    participants, assignments = source.load()
+    sections = {name: source.load_section(name) for name in section_names(directory)}
+
+    backend = SqliteBackend(db_file)
+    backend.import_state(participants, assignments, sections)
+    backend.close()
+    print(f"Перенесено {len(participants)} участников, {len(assignments)} пар "
+          f"и разделы {', '.join(sections) or '-'} в {db_file}")
+
+def migrate(db_file):
+    # The default game's files are in the working directory, every other game's in games/<code>/
+    migrate_game(os.path.dirname(PARTICIPANTS_FILE), db_file)
+    games_dir = os.path.join(os.path.dirname(PARTICIPANTS_FILE), GAMES_DIR)
+    if os.path.isdir(games_dir):
+        for code in sorted(os.listdir(games_dir)):
+            if os.path.isdir(os.path.join(games_dir, code)):
+                migrate_game(os.path.join(games_dir, code), game_file(db_file, code))
+    print("Запусти бота с STORAGE_BACKEND=sqlite, чтобы использовать базу.")
+
+if __name__ == "__main__":
+    migrate(sys.argv[1] if len(sys.argv) > 1 else SQLITE_DB_FILE)
@@ -0,0 +1,179 @@
+import functools
+import logging
+
+from broadcast import FAILED, SENT, BroadcastDispatcher, send_parts
+from storage import StateStore
+
+logger = logging.getLogger(__name__)
+
+# Store section holding the delivery status of each giver's assignment message
+SECTION = "notifications"
+PENDING = "pending"
+
+
+# Telegram rejects longer messages; the limit is counted in UTF-16 code units
+MESSAGE_LIMIT = 4096
+# Prepended to the first chunk when an assignment is announced; chunks leave GREETING_ROOM characters for it
+GREETING = "Поздравляю! "
+REDRAW_GREETING = "Жеребьевка обновилась! "
+GREETING_ROOM = 64
+# Most UTF-16 code units of names listed in one admin message; names past it are only counted
+NAME_LIST_LIMIT = 3000
+
+
+def render_giftee_message(receiver_info: dict) -> str:
+    receiver_link = f" (@{receiver_info['username']})" if receiver_info["username"] else ""
+    return (f"Твой подопечный в Тайном Санте - {receiver_info['name']}{receiver_link}. "
+            f"Вот его письмо деду морозу:\n\n{receiver_info['wishlist']}")
+
+
+def _utf16_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def name_list(names) -> str:
+    """Joins names with commas, up to NAME_LIST_LIMIT; the ones that do not fit are counted ("и еще 12").
+
+    Keeps a report about any number of participants within one message.
+    """
+    names = list(names)
+    shown = []
+    used = 0
+    for name in names:
+        used += _utf16_length(name) + 2
+        if used > NAME_LIST_LIMIT:
+            break
+        shown.append(name)
+    text = ", ".join(shown)
+    if len(shown) < len(names):
+        rest = f"еще {len(names) - len(shown)}"
+        text = f"{text} и {rest}" if shown else rest
+    return text
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> list:
+    """Splits text into chunks Telegram accepts, preferring line breaks, then spaces."""
+    chunks = []
+    while _utf16_length(text) > limit:
+        # Longest prefix that fits; characters outside the BMP count twice
+        end = 0
+        used = 0
+        for char in text:
+            used += 2 if ord(char) > 0xFFFF else 1
+            if used > limit:
+                break
+            end += 1
+        # A break in the first half of the window would waste most of a message
+        cut = text.rfind("\n", end // 2, end + 1)
+        if cut <= 0:
+            cut = text.rfind(" ", end // 2, end + 1)
+        if cut <= 0:
+            cut = end
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n ") if cut < end else text[cut:]
+    chunks.append(text)
+    return chunks
+
+
+def giftee_message(store: StateStore, giver_user_id: str):
+    """Returns the giver's giftee message as message-sized chunks, rendered once and then cached.
+
+    None if the giver has no assignment or the receiver is gone.
+    """
+    chunks = store.giftee_message(giver_user_id)
+    if chunks is None:
+        receiver_user_id = store.assignments.get(giver_user_id)
+        receiver_info = store.participant_by_user_id(receiver_user_id) if receiver_user_id else None
+        if receiver_info is None:
+            return None
+        chunks = split_message(render_giftee_message(receiver_info), MESSAGE_LIMIT - GREETING_ROOM)
+        store.cache_giftee_message(giver_user_id, chunks)
+    return chunks
+
+
+def render_all(store: StateStore) -> None:
+    """Renders every giver's giftee message right after the draw.
+
+    A store with a bounded giftee cache could not keep them all, so there
+    each message is rendered when it is first sent instead.
+    """
+    if store.giftee_cache_size:
+        return
+    for giver_user_id in store.assignments:
+        giftee_message(store, giver_user_id)
+
+
+def chunk_parts(send, chunks: list, reply_markup=None) -> list:
+    """Returns one coroutine function per chunk calling `send(text, reply_markup)`; only the last carries the keyboard."""
+    return [functools.partial(send, chunk, reply_markup if index == len(chunks) - 1 else None)
+            for index, chunk in enumerate(chunks)]
+
+
+async def send_chunks(send, chunks: list, reply_markup=None) -> None:
+    """Sends chunks in order with `send(text, reply_markup)`; only the last one carries the keyboard."""
+    for part in chunk_parts(send, chunks, reply_markup):
+        await part()
+
+
+def mark_all_pending(store: StateStore) -> None:
+    """Resets delivery status for a freshly drawn game: every giver still has to be notified."""
+    statuses = store.section(SECTION)
+    statuses.clear()
+    statuses.update({giver_user_id: PENDING for giver_user_id in store.assignments})
+    store.section_changed(SECTION)
+
+
+def mark_pending(store: StateStore, giver_user_ids) -> None:
+    statuses = store.section(SECTION)
+    statuses.update({giver_user_id: PENDING for giver_user_id in giver_user_ids})
+    store.section_changed(SECTION)
+
+
+def givers_with_status(store: StateStore, *statuses) -> list:
+    return [giver for giver, status in store.section(SECTION).items()
+            if status in statuses and giver in store.assignments]
+
+
+async def notify_givers(bot, store: StateStore, dispatcher: BroadcastDispatcher, giver_user_ids, keyboard_for,
+                        greeting: str = GREETING) -> dict:
+    """Sends each giver their assignment and records the outcome as soon as it is known.
+
+    Statuses are persisted one by one, so if the process dies midway the
+    givers that were not reached stay PENDING and can be resumed later.
+    Returns {giver_user_id: SENT or FAILED}.
+    """
+    statuses = store.section(SECTION)
+    giver_by_chat_id = {}
+    for giver_user_id in giver_user_ids:
+        chat_id = store.chat_id_for_user(giver_user_id)
+        if chat_id is None:
+            logger.error(f"Giver {giver_user_id} is no longer a participant, skipping notification")
+            statuses[giver_user_id] = FAILED
+            continue
+        giver_by_chat_id[chat_id] = giver_user_id
+    store.section_changed(SECTION)
+    # Chunks already sent to each chat, so a retried send does not repeat them
+    delivered = {}
+
+    async def send(chat_id):
+        chunks = giftee_message(store, giver_by_chat_id[chat_id])
+        if chunks is None:
+            raise LookupError(f"No receiver for giver {giver_by_chat_id[chat_id]}")
+        await send_parts(chat_id, chunk_parts(
+            lambda text, reply_markup: bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup),
+            [greeting + chunks[0]] + chunks[1:], keyboard_for(chat_id)
+        ), delivered)
+
+    def record(chat_id, status):
+        statuses[giver_by_chat_id[chat_id]] = status
+        store.section_changed(SECTION)
+
+    results = await dispatcher.run(list(giver_by_chat_id), send, on_result=record)
+    return {giver_by_chat_id[chat_id]: status for chat_id, status in results.items()}
+
+
+def delivery_stats(store: StateStore) -> dict:
+    stats = {PENDING: 0, SENT: 0, FAILED: 0}
+    for status in store.section(SECTION).values():
+        stats[status] = stats.get(status, 0) + 1
+    return stats
@@ -0,0 +1,88 @@
+# Wishlist of a record whose text is kept in storage, not in memory
+STORED = object()
+
+
+class Participant:
+    """One participant's record, with its fields in slots instead of a dict per person.
+
+    Records read like the participant dicts they replace (`info["name"]`,
+    `info.get("username")`, `dict(info)`), so handlers, exports and storage
+    backends work with either. A backend that can read single wishlists
+    passes `load_wishlist(user_id)` and STORED as the wishlist; the text is
+    then fetched whenever it is read instead of being kept in memory.
+    Fields other than the fixed ones go to `extra`.
+    """
+
+    __slots__ = ("user_id", "name", "username", "_wishlist", "_load_wishlist", "extra")
+
+    FIELDS = ("user_id", "name", "username", "wishlist")
+
+    def __init__(self, user_id: str, name=None, username=None, wishlist=None, load_wishlist=None, extra=None):
+        self.user_id = user_id
+        self.name = name
+        self.username = username
+        self._wishlist = wishlist
+        self._load_wishlist = load_wishlist
+        self.extra = extra
+
+    @classmethod
+    def from_mapping(cls, info) -> "Participant":
+        if isinstance(info, Participant):
+            return info
+        extra = {key: value for key, value in info.items() if key not in cls.FIELDS}
+        return cls(info["user_id"], info.get("name"), info.get("username"), info.get("wishlist"),
+                   extra=extra or None)
+
+    @property
+    def has_wishlist(self) -> bool:
+        """Whether the participant wrote a wishlist, answered without loading it."""
+        return bool(self._wishlist)
+
+    @property
+    def wishlist(self):
+        if self._wishlist is STORED:
+            return self._load_wishlist(self.user_id)
+        return self._wishlist
+
+    @wishlist.setter
+    def wishlist(self, text) -> None:
+        self._wishlist = text
+
+    def __getitem__(self, key: str):
+        if key in self.FIELDS:
+            return getattr(self, key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key: str, value) -> None:
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.FIELDS or (self.extra is not None and key in self.extra)
+
+    def keys(self):
+        return list(self.FIELDS) + list(self.extra or ())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.FIELDS) + len(self.extra or ())
+
+    def __repr__(self) -> str:
+        return f"Participant({self.user_id!r}, name={self.name!r})"
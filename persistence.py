@@ -0,0 +1,179 @@
+from abc import ABC, abstractmethod
+import asyncio
+import json
+import logging
+import os
+import tempfile
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def write_json_atomic(path: str, data: dict) -> None:
+    """Writes data to a temp file next to path and renames it into place.
+
+    `data` may also be an already serialized JSON string. A crash in the
+    middle of the write leaves the previous file untouched.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            if isinstance(data, str):
+                f.write(data)
+            else:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class BatchedWriter:
+    """Coalesces save requests and writes them off the event loop.
+
+    schedule() only records which key (a file path, a row) is dirty and how to
+    snapshot it. After `delay` seconds every dirty key is snapshotted once on
+    the event loop and the batch is handed to `write_batch` in a worker thread,
+    so a burst of changes costs one write per key. Without a running loop
+    (scripts, tests) writes happen immediately.
+    """
+
+    def __init__(self, write_batch=None, delay: float = 0.5):
+        self.write_batch = write_batch or write_json_batch
+        self.delay = delay
+        self._pending = {}
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    def schedule(self, key, snapshot) -> None:
+        self._pending[key] = snapshot
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_sync()
+            return
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        while self._pending:
+            await asyncio.sleep(self.delay)
+            await self.flush()
+
+    async def flush(self) -> None:
+        # The lock keeps two flushes from writing the same file concurrently
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            with metrics.STORAGE_SECONDS.time(operation="snapshot"):
+                batch = {key: snapshot() for key, snapshot in pending.items()}
+            try:
+                with metrics.STORAGE_SECONDS.time(operation="write_batch"):
+                    await asyncio.to_thread(self.write_batch, batch)
+            except Exception as e:
+                metrics.STORAGE_ERRORS.inc(operation="write_batch")
+                logger.error(f"Could not persist {len(batch)} pending change(s): {e}")
+                # Retry on the next flush unless a newer snapshot is already queued
+                for key, snapshot in pending.items():
+                    self._pending.setdefault(key, snapshot)
+
+    def flush_sync(self) -> None:
+        pending, self._pending = self._pending, {}
+        self.write_batch({key: snapshot() for key, snapshot in pending.items()})
+
+
+def write_json_batch(batch: dict) -> None:
+    for path, data in batch.items():
+        write_json_atomic(path, data)
+
+
+class StorageBackend(ABC):
+    """Interface between the in-memory StateStore and durable storage.
+
+    The store loads everything once through load() and afterwards only
+    reports what changed; each backend decides how to persist it. A backend
+    missing any of these methods cannot be instantiated.
+    """
+
+    @abstractmethod
+    def load(self):
+        """Returns (participants, assignments) in the participants.json/assignments.json layout.
+
+        Participant records may be dicts or participant.Participant objects.
+        """
+
+    @abstractmethod
+    def participant_changed(self, chat_id: str, participants: dict) -> None:
+        ...
+
+    @abstractmethod
+    def assignments_changed(self, assignments: dict) -> None:
+        ...
+
+    @abstractmethod
+    def load_section(self, name: str) -> dict:
+        """Returns a named auxiliary state dict (delivery status, caches...), empty if never saved."""
+
+    @abstractmethod
+    def section_changed(self, name: str, data: dict) -> None:
+        ...
+
+    @abstractmethod
+    async def flush(self) -> None:
+        ...
+
+
+class JsonBackend(StorageBackend):
+    """Stores state in participants.json and assignments.json, rewriting the whole file per batch.
+
+    Each auxiliary section lives in its own <name>.json next to participants.json.
+    """
+
+    def __init__(self, participants_file: str, assignments_file: str, writer: BatchedWriter = None):
+        self.participants_file = participants_file
+        self.assignments_file = assignments_file
+        self.data_dir = os.path.dirname(participants_file)
+        self.writer = writer or BatchedWriter()
+
+    def load(self):
+        participants_data = _read_json(self.participants_file, {"participants": {}})
+        assignments_data = _read_json(self.assignments_file, {"assignments": {}})
+        return participants_data.get("participants", {}), assignments_data.get("assignments", {})
+
+    def participant_changed(self, chat_id: str, participants: dict) -> None:
+        # Copy each record so the worker thread never sees a half-applied mutation
+        self.writer.schedule(
+            self.participants_file,
+            lambda: {"participants": {c_id: dict(info) for c_id, info in participants.items()}}
+        )
+
+    def assignments_changed(self, assignments: dict) -> None:
+        self.writer.schedule(self.assignments_file, lambda: {"assignments": dict(assignments)})
+
+    def load_section(self, name: str) -> dict:
+        return _read_json(self._section_file(name), {})
+
+    def section_changed(self, name: str, data: dict) -> None:
+        # Serialized on the event loop so the worker thread never sees a half-applied mutation
+        self.writer.schedule(self._section_file(name), lambda: json.dumps(data, ensure_ascii=False))
+
+    def _section_file(self, name: str) -> str:
+        return os.path.join(self.data_dir, f"{name}.json")
+
+    async def flush(self) -> None:
+        await self.writer.flush()
+
+
+def _read_json(path: str, default: dict) -> dict:
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return default
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+
+from broadcast import FAILED, BroadcastDispatcher, send_parts
+import keyboards
+from notifications import chunk_parts, split_message
+from storage import StateStore
+
+logger = logging.getLogger(__name__)
+
+# Who a participant writes to: the person giving them a gift or the person they give one to
+SANTA = "santa"
+GIFTEE = "giftee"
+
+# What the recipient sees above a relayed message, by the direction it was sent in
+HEADERS = {
+    SANTA: f"✉️ Сообщение от твоего подопечного (ответить: «{keyboards.label(keyboards.WRITE_GIFTEE)}»):",
+    GIFTEE: f"✉️ Сообщение от твоего Тайного Санты (ответить: «{keyboards.label(keyboards.WRITE_SANTA)}»):",
+}
+# Relayed messages waiting for delivery; when full, senders are asked to try again later
+OUTBOX_SIZE = 10000
+
+
+def recipient_chat_id(store: StateStore, user_id: str, direction: str):
+    """Returns the chat_id of the user's Santa or giftee, or None if they have none.
+
+    Both directions are dict lookups: giftees through the assignments, Santas
+    through the store's reverse index.
+    """
+    if direction == SANTA:
+        other_user_id = store.giver_for(user_id)
+    else:
+        other_user_id = store.assignments.get(user_id)
+    return store.chat_id_for_user(other_user_id) if other_user_id is not None else None
+
+
+def relayed_sender(bot, message, direction: str):
+    """Returns send(chat_id) that delivers `message` without revealing who wrote it.
+
+    Text is re-sent under the header; anything else (photos, voice, stickers,
+    ...) is copied, which, unlike forwarding, does not show the author.
+    """
+    header = HEADERS[direction]
+    # Parts already sent to each chat, so a retried send does not repeat the header or a chunk
+    delivered = {}
+
+    async def send(chat_id):
+        if message.text:
+            parts = chunk_parts(lambda text, reply_markup: bot.send_message(chat_id=chat_id, text=text),
+                                split_message(f"{header}\n\n{message.text}"))
+        else:
+            parts = [
+                lambda: bot.send_message(chat_id=chat_id, text=header),
+                lambda: bot.copy_message(chat_id=chat_id, from_chat_id=message.chat_id, message_id=message.message_id),
+            ]
+        await send_parts(chat_id, parts, delivered)
+
+    return send
+
+
+class RelayOutbox:
+    """Queue of relayed messages delivered in the background under the shared rate limiter.
+
+    Handlers only enqueue, so a burst of messages before the gift deadline
+    never holds up other updates; `workers` deliveries run at a time, each
+    retried by the dispatcher like any bulk send.
+    """
+
+    def __init__(self, dispatcher: BroadcastDispatcher, workers: int = 4, maxsize: int = OUTBOX_SIZE):
+        self.dispatcher = dispatcher
+        self.workers = workers
+        self.maxsize = maxsize
+        self._queue = None
+        self._tasks = []
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue(self.maxsize)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._queue is not None and not self._queue.empty():
+            logger.warning(f"Dropping {self._queue.qsize()} undelivered relayed messages")
+
+    def put(self, chat_id, send, on_failed=None) -> bool:
+        """Queues send(chat_id); `on_failed()` is awaited if it cannot be delivered. False if the outbox is full."""
+        try:
+            self._queue.put_nowait((chat_id, send, on_failed))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def _work(self) -> None:
+        while True:
+            chat_id, send, on_failed = await self._queue.get()
+            try:
+                results = await self.dispatcher.run([chat_id], send)
+                if results[chat_id] == FAILED and on_failed is not None:
+                    await on_failed()
+            except Exception as e:
+                logger.error(f"Could not relay a message to {chat_id}: {e}")
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,81 @@
+import logging
+
+from broadcast import BroadcastDispatcher
+from storage import StateStore
+
+logger = logging.getLogger(__name__)
+
+# Store section holding, per user_id, the Unix time they were last reminded
+SECTION = "reminders"
+
+NAME_REMINDER = ("Напоминание от Тайного Санты: ты начал регистрацию, но еще не написал свое имя. "
+                 "Просто отправь его ответным сообщением 🎅")
+WISHLIST_REMINDER = ("Напоминание от Тайного Санты: ты еще не написал письмо деду морозу, "
+                     "а без него игра не может начаться. Отправь /wishlist, чтобы написать его 🎁")
+
+
+def parse_quiet_hours(text: str):
+    """Parses "22-9" into (22, 9); returns None for an empty string (no quiet hours)."""
+    if not text:
+        return None
+    start, end = text.split("-")
+    return int(start) % 24, int(end) % 24
+
+
+def in_quiet_hours(hour: int, quiet_hours) -> bool:
+    """Whether `hour` falls in [start, end), which may wrap around midnight."""
+    if quiet_hours is None:
+        return False
+    start, end = quiet_hours
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def stragglers(store: StateStore, chats_without_name=()) -> list:
+    """Returns (chat_id, user_id, text) for everyone in the game who still has to do something.
+
+    Participants without a wishlist come from the store's own set, so this
+    never scans the participants. `chats_without_name` are (chat_id, user_id)
+    of chats that started joining this game but never sent their name.
+    """
+    pending = [(chat_id, user_id, NAME_REMINDER) for chat_id, user_id in chats_without_name
+               if not store.is_participant(chat_id)]
+    for chat_id in store.missing_wishlists():
+        pending.append((chat_id, store.participants[chat_id]["user_id"], WISHLIST_REMINDER))
+    return pending
+
+
+def due(store: StateStore, pending: list, now: float, interval: float, limit: int) -> list:
+    """Returns at most `limit` of `pending` whose user was not reminded in the last `interval` seconds."""
+    reminded = store.section(SECTION)
+    selected = []
+    for entry in pending:
+        if now - reminded.get(entry[1], 0) >= interval:
+            selected.append(entry)
+            if len(selected) >= limit:
+                break
+    return selected
+
+
+async def send_reminders(bot, store: StateStore, dispatcher: BroadcastDispatcher, batch: list, now: float,
+                         keyboard_for) -> dict:
+    """Sends one batch of reminders through the shared rate limiter; returns {chat_id: SENT or FAILED}.
+
+    Every user in the batch gets `now` as their last reminder time whatever
+    the outcome, so a blocked bot or a restart does not lead to repeated
+    nudges before the interval is over.
+    """
+    reminded = store.section(SECTION)
+    entries = {chat_id: (user_id, text) for chat_id, user_id, text in batch}
+
+    async def send(chat_id):
+        await bot.send_message(chat_id=chat_id, text=entries[chat_id][1], reply_markup=keyboard_for(chat_id))
+
+    def record(chat_id, status):
+        reminded[entries[chat_id][0]] = now
+        store.section_changed(SECTION)
+
+    results = await dispatcher.run(list(entries), send, on_result=record)
+    logger.info(f"Sent {len(results)} reminders")
+    return results
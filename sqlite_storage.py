@@ -0,0 +1,149 @@
+import json
+import logging
+import sqlite3
+
+from participant import STORED, Participant
+from persistence import BatchedWriter, StorageBackend
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS participants (
+    chat_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    name TEXT,
+    username TEXT,
+    wishlist TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_participants_user_id ON participants (user_id);
+CREATE INDEX IF NOT EXISTS idx_participants_name ON participants (name);
+CREATE TABLE IF NOT EXISTS assignments (
+    giver_user_id TEXT PRIMARY KEY,
+    receiver_user_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_assignments_receiver ON assignments (receiver_user_id);
+CREATE TABLE IF NOT EXISTS sections (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+# Participant fields with their own column; anything else goes to the `extra` JSON blob
+PARTICIPANT_COLUMNS = ("user_id", "name", "username", "wishlist")
+
+
+class SqliteBackend(StorageBackend):
+    """Stores state in a local SQLite file, writing only the rows that changed.
+
+    participants are keyed by chat_id and indexed by user_id and name, so
+    large groups never pay for a full-file rewrite. Wishlist texts are not
+    loaded with the participants; each is read from the database when it is
+    needed.
+    """
+
+    def __init__(self, db_file: str, writer: BatchedWriter = None):
+        self.db_file = db_file
+        # Writes run in the BatchedWriter's worker thread, one batch at a time
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self.writer = writer or BatchedWriter(self._write_batch)
+        # Lazy wishlist reads happen on the event loop, on their own connection (WAL lets it read alongside writes)
+        self._reader = None
+
+    def load(self):
+        participants = {}
+        for row in self.connection.execute(
+            "SELECT chat_id, user_id, name, username, COALESCE(wishlist, '') != '', extra FROM participants"
+        ):
+            chat_id, user_id, name, username, has_wishlist, extra = row
+            participants[chat_id] = Participant(
+                user_id, name, username, STORED if has_wishlist else None, self.load_wishlist,
+                json.loads(extra) if extra else None
+            )
+        assignments = dict(self.connection.execute("SELECT giver_user_id, receiver_user_id FROM assignments"))
+        return participants, assignments
+
+    def participant_changed(self, chat_id: str, participants: dict) -> None:
+        def snapshot():
+            info = participants.get(chat_id)
+            return dict(info) if info is not None else None
+        self.writer.schedule(("participant", chat_id), snapshot)
+
+    def load_wishlist(self, user_id: str):
+        if self._reader is None:
+            self._reader = sqlite3.connect(self.db_file)
+        row = self._reader.execute("SELECT wishlist FROM participants WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def assignments_changed(self, assignments: dict) -> None:
+        self.writer.schedule(("assignments",), lambda: dict(assignments))
+
+    def load_section(self, name: str) -> dict:
+        row = self.connection.execute("SELECT data FROM sections WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def section_changed(self, name: str, data: dict) -> None:
+        # Serialized on the event loop so the worker thread never sees a half-applied mutation
+        self.writer.schedule(("section", name), lambda: json.dumps(data, ensure_ascii=False))
+
+    async def flush(self) -> None:
+        await self.writer.flush()
+
+    def import_state(self, participants: dict, assignments: dict, sections: dict = None) -> None:
+        """Replaces the database contents in a single transaction (used by migrate_to_sqlite.py).
+
+        `sections` maps section names to their data, as load_section returns it.
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM participants")
+            self.connection.executemany(
+                "INSERT INTO participants (chat_id, user_id, name, username, wishlist, extra) VALUES (?, ?, ?, ?, ?, ?)",
+                (_participant_to_row(chat_id, info) for chat_id, info in participants.items())
+            )
+            self._replace_assignments(assignments)
+            self.connection.execute("DELETE FROM sections")
+            self.connection.executemany(
+                "INSERT INTO sections (name, data) VALUES (?, ?)",
+                ((name, json.dumps(data, ensure_ascii=False)) for name, data in (sections or {}).items())
+            )
+
+    def close(self) -> None:
+        self.connection.close()
+        if self._reader is not None:
+            self._reader.close()
+
+    def _write_batch(self, batch: dict) -> None:
+        with self.connection:
+            for key, data in batch.items():
+                if key[0] == "assignments":
+                    self._replace_assignments(data)
+                elif key[0] == "section":
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO sections (name, data) VALUES (?, ?)", (key[1], data)
+                    )
+                elif data is None:
+                    self.connection.execute("DELETE FROM participants WHERE chat_id = ?", (key[1],))
+                else:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO participants (chat_id, user_id, name, username, wishlist, extra) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        _participant_to_row(key[1], data)
+                    )
+
+    def _replace_assignments(self, assignments: dict) -> None:
+        self.connection.execute("DELETE FROM assignments")
+        self.connection.executemany(
+            "INSERT INTO assignments (giver_user_id, receiver_user_id) VALUES (?, ?)",
+            assignments.items()
+        )
+
+
+def _participant_to_row(chat_id: str, info: dict) -> tuple:
+    extra = {key: value for key, value in info.items() if key not in PARTICIPANT_COLUMNS}
+    return (
+        chat_id, info["user_id"], info.get("name"), info.get("username"), info.get("wishlist"),
+        json.dumps(extra, ensure_ascii=False) if extra else None
+    )
+
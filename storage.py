@@ -0,0 +1,244 @@
+import logging
+
+import keyboards
+import metrics
+from participant import Participant
+from persistence import StorageBackend
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore:
+    """Process-wide in-memory copy of the participants and assignments.
+
+    Everything is read once from the storage backend by load(). Handlers read
+    from memory, and lookups by user_id and name go through indexes kept next
+    to the data. Mutating methods never await, so on the event loop each one
+    is applied atomically and concurrent handlers cannot overwrite each
+    other's changes; the backend persists them in batches. Participants are
+    compact Participant records; backends that can read single wishlists
+    keep the wishlist text out of memory until it is needed.
+    """
+
+    def __init__(self, backend: StorageBackend, giftee_cache_size: int = 0):
+        self.backend = backend
+        # Most giftee messages kept rendered at once; 0 keeps all of them
+        self.giftee_cache_size = giftee_cache_size
+        self.participants = {}
+        self.assignments = {}
+        self._chat_id_by_user_id = {}
+        self._user_ids_by_name = {}
+        # Lowercased Telegram username -> user_ids; usernames are case-insensitive
+        self._user_ids_by_username = {}
+        # chat_ids of participants who have not written a wishlist yet
+        self._missing_wishlist = set()
+        self._sections = {}
+        # chat_id -> keyboards.* state, dropped whenever that chat or the assignments change
+        self._chat_states = {}
+        # receiver user_id -> giver user_id, the reverse of assignments
+        self._giver_by_receiver = {}
+        # giver user_id -> rendered giftee message chunks, dropped when the receiver or assignments change;
+        # with a giftee_cache_size it is kept in least recently used order
+        self._giftee_messages = {}
+
+    def load(self) -> None:
+        with metrics.STORAGE_SECONDS.time(operation="load"):
+            participants, self.assignments = self.backend.load()
+        # Records are slotted objects, not a dict per participant; backends may already return them
+        self.participants = {chat_id: Participant.from_mapping(info) for chat_id, info in participants.items()}
+        self._sections = {}
+        self._chat_states = {}
+        self._giver_by_receiver = {receiver: giver for giver, receiver in self.assignments.items()}
+        self._giftee_messages = {}
+        self._chat_id_by_user_id = {}
+        self._user_ids_by_name = {}
+        self._user_ids_by_username = {}
+        self._missing_wishlist = set()
+        for chat_id, info in self.participants.items():
+            self._index(chat_id, info)
+            self._track_wishlist(chat_id, info)
+        logger.info(
+            f"Loaded {len(self.participants)} participants and {len(self.assignments)} assignments"
+        )
+
+    @property
+    def game_started(self) -> bool:
+        return bool(self.assignments)
+
+    def is_participant(self, chat_id: str) -> bool:
+        return chat_id in self.participants
+
+    def get_participant(self, chat_id: str):
+        return self.participants.get(chat_id)
+
+    def chat_state(self, chat_id: str) -> str:
+        """Returns which main keyboard the chat should see, cached until its data changes."""
+        state = self._chat_states.get(chat_id)
+        if state is None:
+            participant_info = self.participants.get(chat_id)
+            if participant_info is None:
+                state = keyboards.NOT_JOINED
+            elif not self.game_started:
+                state = keyboards.JOINED
+            elif participant_info["user_id"] in self.assignments:
+                state = keyboards.IN_GAME_WITH_ASSIGNMENT
+            else:
+                state = keyboards.IN_GAME
+            self._chat_states[chat_id] = state
+        return state
+
+    def chat_id_for_user(self, user_id: str):
+        return self._chat_id_by_user_id.get(user_id)
+
+    def participant_by_user_id(self, user_id: str):
+        chat_id = self._chat_id_by_user_id.get(user_id)
+        return self.participants.get(chat_id) if chat_id is not None else None
+
+    def user_ids_by_name(self, name: str) -> set:
+        return self._user_ids_by_name.get(name, set())
+
+    def user_ids_by_username(self, username: str) -> set:
+        return self._user_ids_by_username.get(username.lower(), set())
+
+    def user_ids(self):
+        """All participants' user_ids, without building a list of records."""
+        return self._chat_id_by_user_id.keys()
+
+    def missing_wishlists(self) -> set:
+        """Returns the chat_ids of participants without a wishlist; callers must not modify it."""
+        return self._missing_wishlist
+
+    def giver_for(self, receiver_user_id: str):
+        return self._giver_by_receiver.get(receiver_user_id)
+
+    def giftee_message(self, giver_user_id: str):
+        """Returns the cached rendering of the giver's giftee message, or None."""
+        chunks = self._giftee_messages.get(giver_user_id)
+        if chunks is not None and self.giftee_cache_size:
+            # Move to the most recently used end
+            self._giftee_messages[giver_user_id] = self._giftee_messages.pop(giver_user_id)
+        return chunks
+
+    def cache_giftee_message(self, giver_user_id: str, chunks: list) -> None:
+        self._giftee_messages[giver_user_id] = chunks
+        if self.giftee_cache_size and len(self._giftee_messages) > self.giftee_cache_size:
+            del self._giftee_messages[next(iter(self._giftee_messages))]
+
+    def set_name(self, chat_id: str, user_id: str, name: str, username) -> Participant:
+        participant_info = self.participants.get(chat_id)
+        if participant_info is None:
+            participant_info = Participant(user_id)
+        else:
+            self._unindex(chat_id, participant_info)
+        participant_info["name"] = name
+        participant_info["username"] = username
+        self.participants[chat_id] = participant_info
+        self._index(chat_id, participant_info)
+        self._track_wishlist(chat_id, participant_info)
+        self._chat_states.pop(chat_id, None)
+        self._receiver_changed(user_id)
+        self.backend.participant_changed(chat_id, self.participants)
+        return participant_info
+
+    def set_wishlist(self, chat_id: str, wishlist_text: str) -> bool:
+        participant_info = self.participants.get(chat_id)
+        if participant_info is None:
+            return False
+        participant_info["wishlist"] = wishlist_text
+        self._track_wishlist(chat_id, participant_info)
+        self._receiver_changed(participant_info["user_id"])
+        self.backend.participant_changed(chat_id, self.participants)
+        return True
+
+    def remove_participant(self, chat_id: str):
+        """Deletes a participant and returns their record; their assignment is left to the caller."""
+        participant_info = self.participants.pop(chat_id, None)
+        if participant_info is None:
+            return None
+        self._unindex(chat_id, participant_info)
+        if self._chat_id_by_user_id.get(participant_info["user_id"]) == chat_id:
+            del self._chat_id_by_user_id[participant_info["user_id"]]
+        self._missing_wishlist.discard(chat_id)
+        self._chat_states.pop(chat_id, None)
+        self._receiver_changed(participant_info["user_id"])
+        self.backend.participant_changed(chat_id, self.participants)
+        return participant_info
+
+    def update_assignments(self, changes: dict, removed=()) -> None:
+        """Applies an incremental re-draw: `changes` maps givers to new receivers, `removed` givers leave.
+
+        Only the affected givers' cached messages and keyboards are dropped.
+        """
+        for giver_user_id in removed:
+            receiver_user_id = self.assignments.pop(giver_user_id, None)
+            if self._giver_by_receiver.get(receiver_user_id) == giver_user_id:
+                del self._giver_by_receiver[receiver_user_id]
+            self._giver_by_receiver.pop(giver_user_id, None)
+            self._giver_changed(giver_user_id)
+        for giver_user_id, receiver_user_id in changes.items():
+            self.assignments[giver_user_id] = receiver_user_id
+            self._giver_by_receiver[receiver_user_id] = giver_user_id
+            self._giver_changed(giver_user_id)
+        self.backend.assignments_changed(self.assignments)
+
+    def set_assignments(self, assignments: dict) -> None:
+        self.assignments = assignments
+        self._chat_states.clear()
+        self._giver_by_receiver = {receiver: giver for giver, receiver in assignments.items()}
+        self._giftee_messages.clear()
+        self.backend.assignments_changed(self.assignments)
+
+    def section(self, name: str) -> dict:
+        """Returns a named auxiliary state dict, loaded from the backend on first use.
+
+        Callers mutate it in place and then call section_changed(name).
+        """
+        data = self._sections.get(name)
+        if data is None:
+            with metrics.STORAGE_SECONDS.time(operation="load_section"):
+                data = self._sections[name] = self.backend.load_section(name)
+        return data
+
+    def section_changed(self, name: str) -> None:
+        self.backend.section_changed(name, self.section(name))
+
+    async def flush(self) -> None:
+        """Writes any pending changes to durable storage."""
+        await self.backend.flush()
+
+    def _receiver_changed(self, user_id: str) -> None:
+        giver_user_id = self._giver_by_receiver.get(user_id)
+        if giver_user_id is not None:
+            self._giftee_messages.pop(giver_user_id, None)
+
+    def _giver_changed(self, giver_user_id: str) -> None:
+        self._giftee_messages.pop(giver_user_id, None)
+        chat_id = self._chat_id_by_user_id.get(giver_user_id)
+        if chat_id is not None:
+            self._chat_states.pop(chat_id, None)
+
+    def _track_wishlist(self, chat_id: str, info: Participant) -> None:
+        if info.has_wishlist:
+            self._missing_wishlist.discard(chat_id)
+        else:
+            self._missing_wishlist.add(chat_id)
+
+    def _index(self, chat_id: str, info: dict) -> None:
+        self._chat_id_by_user_id[info["user_id"]] = chat_id
+        if info.get("name") is not None:
+            self._user_ids_by_name.setdefault(info["name"], set()).add(info["user_id"])
+        if info.get("username"):
+            self._user_ids_by_username.setdefault(info["username"].lower(), set()).add(info["user_id"])
+
+    def _unindex(self, chat_id: str, info: dict) -> None:
+        _discard(self._user_ids_by_name, info.get("name"), info["user_id"])
+        if info.get("username"):
+            _discard(self._user_ids_by_username, info["username"].lower(), info["user_id"])
+
+
+def _discard(index: dict, key, user_id: str) -> None:
+    user_ids = index.get(key)
+    if user_ids is not None:
+        user_ids.discard(user_id)
+        if not user_ids:
+            del index[key]
@@ -0,0 +1,54 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Admission limit handed to PTB. It only bounds how many updates may wait for their chat
+# or for a slot; the real concurrency cap is enforced by PerChatUpdateProcessor itself.
+MAX_QUEUED_UPDATES = 1 << 16
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different chats concurrently and updates from one chat in order.
+
+    PTB starts a task per update in arrival order; each task first waits for
+    its chat's lock (asyncio locks are FIFO) and only then for one of
+    `max_running` global slots, so a busy chat never holds slots that other
+    chats could use. Since a chat's updates never overlap, ConversationHandler
+    state and context.user_data see them one at a time as before.
+    """
+
+    def __init__(self, max_running: int):
+        if max_running < 1:
+            raise ValueError("max_running must be a positive integer")
+        super().__init__(MAX_QUEUED_UPDATES)
+        self.max_running = max_running
+        self._slots = asyncio.Semaphore(max_running)
+        # chat_id -> [lock, number of updates holding or waiting for it]
+        self._chat_locks = {}
+
+    async def do_process_update(self, update, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._chat_locks.get(chat.id)
+        if entry is None:
+            entry = self._chat_locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
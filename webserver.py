@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from collections import namedtuple
+from http import HTTPStatus
+
+logger = logging.getLogger(__name__)
+
+# Telegram updates are small; anything bigger than this is not for us
+MAX_BODY_SIZE = 1 << 20
+READ_TIMEOUT = 10
+
+Request = namedtuple("Request", ["method", "path", "headers", "body"])
+
+
+class Response:
+    def __init__(self, status: int = 200, body: bytes = b"", content_type: str = "text/plain; charset=utf-8"):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+
+
+class HttpServer:
+    """Minimal asyncio HTTP/1.1 server for the webhook and service endpoints.
+
+    Routes are matched exactly on (method, path) and handlers are coroutines
+    taking a Request and returning a Response. Every connection serves a
+    single request, which is all Telegram and the platform health checks need.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self._server = None
+
+    def add_route(self, method: str, path: str, handler) -> None:
+        self.routes[(method, path)] = handler
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info(f"HTTP server listening on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                request = await asyncio.wait_for(_read_request(reader), READ_TIMEOUT)
+            except (ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                logger.warning(f"Rejected malformed HTTP request: {e!r}")
+                response = Response(HTTPStatus.BAD_REQUEST, b"bad request")
+            else:
+                response = await self._dispatch(request)
+            writer.write(_format_response(response))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request: Request) -> Response:
+        if request is None:
+            return Response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, b"request too large")
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self.routes):
+                return Response(HTTPStatus.METHOD_NOT_ALLOWED, b"method not allowed")
+            return Response(HTTPStatus.NOT_FOUND, b"not found")
+        try:
+            return await handler(request)
+        except Exception:
+            logger.exception(f"Error while handling {request.method} {request.path}")
+            return Response(HTTPStatus.INTERNAL_SERVER_ERROR, b"internal error")
+
+
+async def _read_request(reader: asyncio.StreamReader):
+    request_line = await reader.readline()
+    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY_SIZE:
+        return None
+    body = await reader.readexactly(length) if length else b""
+    return Request(method, target.split("?", 1)[0], headers, body)
+
+
+def _format_response(response: Response) -> bytes:
+    status = HTTPStatus(response.status)
+    head = (
+        f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+        f"Content-Type: {response.content_type}\r\n"
+        f"Content-Length: {len(response.body)}\r\n"
+        "Connection: close\r\n\r\n"
+    )
+    return head.encode("latin-1") + response.body